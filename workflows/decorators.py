@@ -1,11 +1,168 @@
 # coding=utf-8
+import hashlib
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from django.db import connections, models
+from django.db.models import Count
+from django.db.transaction import atomic
 from django.utils.translation import ugettext_lazy as _
 
+from graph import get_graph, get_model_workflow
 from models import WorkflowBase, State
-from utils import get_wf_dict_value
+from utils import (
+    chunks, do_transition_bulk, get_allowed_transitions_bulk, get_wf_dict_value, init_workflow_state_bulk
+)
+
+
+class WorkflowQuerySetMixin(object):
+    """Queryset methods shared by every workflow enabled model.
+    """
+    _allowed_transitions_user = None
+    _allowed_transitions_done = False
+
+    def with_allowed_transitions(self, user):
+        """Returns a new queryset which attaches the allowed transitions of
+        the passed user to each instance when the queryset is evaluated, with a
+        constant number of queries (see utils.get_allowed_transitions_bulk).
+        """
+        return self._clone(_allowed_transitions_user=user)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is None and '_allowed_transitions_user' not in kwargs:
+            kwargs['_allowed_transitions_user'] = self._allowed_transitions_user
+        return super(WorkflowQuerySetMixin, self)._clone(klass, setup, **kwargs)
+
+    def _fetch_all(self):
+        super(WorkflowQuerySetMixin, self)._fetch_all()
+        if self._allowed_transitions_user is not None and not self._allowed_transitions_done:
+            get_allowed_transitions_bulk(self._result_cache, self._allowed_transitions_user)
+            self._allowed_transitions_done = True
+
+    def state_counts(self, cache_timeout=None):
+        """Returns a dict state name -> number of objects of the queryset in
+        the state, with one GROUP BY query on the current state column. Every
+        state of the model's workflow is in the dict, with 0 if no object is
+        in it. The objects without state (or in a state of another workflow)
+        are counted under None, if there are any.
+
+        **Parameters:**
+
+        cache_timeout
+            If given, the counts are kept in the cache for that many seconds
+            (useful for dashboards over very large tables). The cache key is
+            built from the SQL of the queryset.
+        """
+        key = None
+        if cache_timeout:
+            sql = u"%s %s" % (self.db, self.query)
+            key = "WORKFLOWS_STATE_COUNTS_%s" % hashlib.md5(sql.encode('utf-8')).hexdigest()
+            counts = cache.get(key)
+            if counts is not None:
+                return counts
+
+        workflow = get_model_workflow(self.model)
+        graph = get_graph(workflow) if workflow else None
+        states = graph.states if graph else {}
+
+        counts = dict((state.name, 0) for state in states.values())
+        rows = self.order_by().values_list('current_state').annotate(count=Count('pk'))
+        for state_id, count in rows:
+            name = states[state_id].name if state_id in states else None
+            counts[name] = counts.get(name, 0) + count
+
+        if key is not None:
+            cache.set(key, counts, cache_timeout)
+        return counts
+
+    def do_transition_bulk(self, transition, user, comment=None):
+        """Processes the passed transition to every object of the queryset
+        (if allowed). See utils.do_transition_bulk.
+        """
+        return do_transition_bulk(self, transition, user, comment)
+
+    def bulk_create(self, objs, batch_size=None, user=None, comment=u""):
+        """Inserts the passed instances like QuerySet.bulk_create, and gives
+        them the initial state of the model's workflow: the state relations,
+        permissions, history and user roles of all of them are created with
+        bulk inserts.
+
+        The primary keys are needed for the related rows. When they are not
+        set beforehand they are reserved from the sequence of the table on
+        PostgreSQL, and read back after the insert on SQLite (see
+        _bulk_insert). On the other databases the instances are inserted one
+        by one, sending the model signals.
+        """
+        objs = list(objs)
+        if not objs:
+            return objs
+
+        workflow = get_model_workflow(self.model)
+        state = get_graph(workflow).get_initial_state() if workflow else None
+        for obj in objs:
+            obj.current_state = state
+
+        with atomic(using=self.db):
+            self._bulk_insert(objs, batch_size)
+
+            if state is not None:
+                for batch in chunks(objs, batch_size):
+                    init_workflow_state_bulk(self.model, batch, workflow, state, user, comment)
+            self.model.fix_user_roles_bulk(objs)
+
+        # the instances are saved, so a later save doesn't apply their state again
+        for obj in objs:
+            obj._loaded_values = obj._get_field_values()
+        return objs
+
+    def _bulk_insert(self, objs, batch_size):
+        """Inserts the passed instances and sets their primary keys. Must be
+        called within a transaction.
+        """
+        connection = connections[self.db]
+        meta = self.model._meta
+        bulk_create = super(WorkflowQuerySetMixin, self).bulk_create
+
+        if all(obj.pk is not None for obj in objs):
+            bulk_create(objs, batch_size)
+        elif any(obj.pk is not None for obj in objs) or not isinstance(meta.pk, models.AutoField):
+            for obj in objs:
+                obj.save_base(force_insert=True, using=self.db)
+        elif connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                [connection.ops.quote_name(meta.db_table), meta.pk.column, len(objs)]
+            )
+            for obj, (pk,) in zip(objs, cursor.fetchall()):
+                obj.pk = pk
+            bulk_create(objs, batch_size)
+        elif connection.vendor == 'sqlite':
+            bulk_create(objs, batch_size)
+            # the transaction holds the write lock of the database since the
+            # first insert, and sqlite gives each row the id following the
+            # greatest one, so the new rows have the greatest consecutive ids
+            last_pk = self.model._base_manager.using(self.db).order_by('-pk').values_list('pk', flat=True)[0]
+            for pk, obj in enumerate(objs, last_pk - len(objs) + 1):
+                obj.pk = pk
+        else:
+            for obj in objs:
+                obj.save_base(force_insert=True, using=self.db)
+
+
+class WorkflowManagerMixin(object):
+    """Manager methods shared by every workflow enabled model.
+    """
+
+    def with_allowed_transitions(self, user):
+        return self.get_queryset().with_allowed_transitions(user)
+
+    def do_transition_bulk(self, transition, user, comment=None):
+        return self.get_queryset().do_transition_bulk(transition, user, comment)
+
+    def state_counts(self, cache_timeout=None):
+        return self.get_queryset().state_counts(cache_timeout)
 
 
 def create_transition_method(transition_name, transition_condition=''):
@@ -25,10 +182,12 @@ def create_transition_method(transition_name, transition_condition=''):
 
 def create_state_method(state_name):
     def state_method(self):
-        try:
-            state = State.objects.get(name=state_name, workflow=self.get_workflow())
-        except State.DoesNotExist:
+        workflow = self.get_workflow()
+        state = get_graph(workflow).get_state(state_name) if workflow else None
+        if state is None:
             return False
+        if self.current_state_id is not None:
+            return self.current_state_id == state.id
         return self.get_state() == state
     return state_method
 
@@ -42,7 +201,13 @@ def create_manager_state_method(state_name):
 
 def create_queryset_state_method(state_name):
     def queryset_state_method(self):
-        return self.filter(current_state__name=state_name)
+        # the state id comes from the compiled graph of the model's workflow,
+        # so the filter needs no join and ignores the states of other workflows
+        workflow = get_model_workflow(self.model)
+        state = get_graph(workflow).get_state(state_name) if workflow else None
+        if state is None:
+            return self.none()
+        return self.filter(current_state=state.id)
     return queryset_state_method
 
 
@@ -67,7 +232,8 @@ def workflow_enabled(cls):
         bases.insert(0, WorkflowBase)
         cls.__bases__ = tuple(bases)
 
-        current_state = models.ForeignKey(State, verbose_name=_(u"State"), name='current_state', null=True, blank=True)
+        current_state = models.ForeignKey(State, verbose_name=_(u"State"), name='current_state', null=True, blank=True,
+                                          db_index=True)
         current_state.contribute_to_class(cls=cls, name='current_state')
 
 
@@ -79,6 +245,9 @@ def workflow_enabled(cls):
     except KeyError:
         raise ImproperlyConfigured('The attribute or key (name), must be specified in the workflow configuration.')
 
+    # compiling the user roles
+    cls.get_user_roles_spec()
+
     # building transition methods
     transitions = get_wf_dict_value(wf_item, 'transitions', wf_name)
     for transition in transitions:
@@ -91,10 +260,10 @@ def workflow_enabled(cls):
         if not cls_transition_method:
             setattr(cls, method_name, create_transition_method(name, condition))
 
-    class CustomQuerySetMixin(object):
+    class CustomQuerySetMixin(WorkflowQuerySetMixin):
         pass
 
-    class CustomManagerMixin(object):
+    class CustomManagerMixin(WorkflowManagerMixin):
 
         def get_queryset(self):
             return CustomQuerySetMixin(self.model, using=self._db)
@@ -0,0 +1,535 @@
+# coding=utf-8
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+
+class CompiledWorkflow(object):
+    """Read-only, in-memory representation of a workflow definition.
+
+    It is built once from the database and shared by every caller of the
+    process, so the mappings below must never be modified in place.
+
+    **Attributes:**
+
+    id
+        The id of the compiled workflow.
+
+    name
+        The unique name of the compiled workflow.
+
+    initial_state_id
+        The id of the workflow's initial state (falls back to the first state
+        if no initial state has been defined).
+
+    states
+        A dict state id -> State instance.
+
+    transitions
+        A dict transition id -> Transition instance.
+
+    state_transitions
+        A dict state id -> tuple of transition ids leaving the state.
+
+    transition_permissions
+        A dict transition id -> id of the permission protecting the
+        transition (None for unprotected transitions).
+
+    state_permissions
+        A dict state id -> frozenset of (role id, permission id) pairs granted
+        by the state's StatePermissionRelation rows (the permission matrix of
+        the workflow).
+
+    permission_ids
+        A dict codename -> id of the permissions of the workflow (see
+        WorkflowPermissionRelation) and of its StatePermissionRelation rows.
+
+    workflow_permission_ids
+        A frozenset with the ids of the permissions the workflow is
+        responsible for (see WorkflowPermissionRelation).
+    """
+
+    def __init__(self, workflow, states, transitions, state_transitions, state_permissions, permissions=None,
+                 workflow_permission_ids=()):
+        self.id = workflow.id
+        self.name = workflow.name
+        self.states = dict((state.id, state) for state in states)
+        self.transitions = dict((transition.id, transition) for transition in transitions)
+        self.state_ids = dict((state.name, state.id) for state in states)
+        self.transition_ids = dict((transition.name, transition.id) for transition in transitions)
+        self.state_transitions = dict(
+            (state.id, tuple(state_transitions.get(state.id, ()))) for state in states
+        )
+        self.transition_permissions = dict(
+            (transition.id, transition.permission_id) for transition in transitions
+        )
+        self.state_permissions = dict(
+            (state.id, frozenset(state_permissions.get(state.id, ()))) for state in states
+        )
+        self.permission_ids = dict(permissions or {})
+        self.workflow_permission_ids = frozenset(workflow_permission_ids)
+
+        if workflow.initial_state_id is not None:
+            self.initial_state_id = workflow.initial_state_id
+        else:
+            self.initial_state_id = states[0].id if states else None
+
+    def __contains__(self, state_or_transition):
+        from models import State, Transition
+
+        if isinstance(state_or_transition, State):
+            return state_or_transition.id in self.states
+        if isinstance(state_or_transition, Transition):
+            return state_or_transition.id in self.transitions
+        return False
+
+    def get_state(self, name):
+        """Returns the state with the passed name or None.
+        """
+        return self.states.get(self.state_ids.get(name))
+
+    def get_initial_state(self):
+        """Returns the initial state of the workflow or None.
+        """
+        return self.states.get(self.initial_state_id)
+
+    def get_transition(self, name):
+        """Returns the transition with the passed name or None.
+        """
+        return self.transitions.get(self.transition_ids.get(name))
+
+    def get_transitions(self, state):
+        """Returns the transitions leaving the passed state (a State instance
+        or a state id).
+        """
+        state_id = getattr(state, 'id', state)
+        return [self.transitions[t_id] for t_id in self.state_transitions.get(state_id, ())]
+
+    def get_permissions(self, state, role=None):
+        """Returns a frozenset with the ids of the permissions granted in the
+        passed state, to the passed role only if given.
+
+        **Parameters:**
+
+        state
+            A State instance or a state id.
+
+        role
+            A Role instance or a role id.
+        """
+        pairs = self.state_permissions.get(getattr(state, 'id', state), ())
+        if role is None:
+            return frozenset(permission_id for role_id, permission_id in pairs)
+        role_id = getattr(role, 'id', role)
+        return frozenset(permission_id for r_id, permission_id in pairs if r_id == role_id)
+
+    def get_roles(self, state, permission):
+        """Returns a frozenset with the ids of the roles which have the passed
+        permission in the passed state.
+
+        **Parameters:**
+
+        state
+            A State instance or a state id.
+
+        permission
+            A Permission instance, a permission id or a permission codename.
+        """
+        permission_id = self._get_permission_id(permission)
+        pairs = self.state_permissions.get(getattr(state, 'id', state), ())
+        return frozenset(role_id for role_id, p_id in pairs if p_id == permission_id)
+
+    def has_permission(self, state, role, permission):
+        """Returns True if the passed role has the passed permission in the
+        passed state (see get_roles for the accepted values).
+        """
+        pair = (getattr(role, 'id', role), self._get_permission_id(permission))
+        return pair in self.state_permissions.get(getattr(state, 'id', state), ())
+
+    def _get_permission_id(self, permission):
+        if isinstance(permission, basestring):
+            return self.permission_ids.get(permission)
+        return getattr(permission, 'id', permission)
+
+
+_graphs = {}
+_graph_ids = {}
+_definitions_version = None
+_lock = threading.Lock()
+
+_DEFINITIONS_VERSION_KEY = "WORKFLOWS_DEFINITIONS_VERSION"
+
+
+_versions = {}
+
+
+def _get_version(key):
+    """Returns the current version stored in the shared cache under the passed
+    key, creating one if there is none. The shared cache is read at most once
+    every WORKFLOWS_VERSION_CHECK_INTERVAL seconds (1 by default) per key and
+    process, so the changes made by other processes are seen after at most
+    that delay.
+    """
+    now = time.time()
+    version, checked_at = _versions.get(key, (None, None))
+    if checked_at is None or now - checked_at >= getattr(settings, 'WORKFLOWS_VERSION_CHECK_INTERVAL', 1):
+        version = cache.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.add(key, version, None)
+            # another process may have added one first
+            version = cache.get(key) or version
+        _versions[key] = (version, now)
+    return version
+
+
+def _set_new_version(key):
+    """Gives a new version to the passed key of the shared cache. The versions
+    never expire, so the process-local caches are only reloaded when they
+    changed.
+    """
+    version = uuid.uuid4().hex
+    cache.set(key, version, None)
+    _versions[key] = (version, time.time())
+    return version
+
+
+def _clear_definitions():
+    with _lock:
+        _graphs.clear()
+        _graph_ids.clear()
+        _workflows.clear()
+        _model_workflows.clear()
+
+
+def _check_definitions_version():
+    """Drops the compiled workflows, the Workflow instances and the model
+    workflows of the process if their version in the shared cache changed,
+    i.e. if a workflow definition has been changed by any process since they
+    were loaded (see invalidate_graph and invalidate_workflows).
+    """
+    global _definitions_version
+
+    version = _get_version(_DEFINITIONS_VERSION_KEY)
+    if version != _definitions_version:
+        _clear_definitions()
+        _definitions_version = version
+
+
+def _set_new_definitions_version():
+    """Gives a new version to the workflow definitions after a change made by
+    this process, whose caches are kept in sync by the signals. They are only
+    dropped if another process changed the definitions before.
+    """
+    global _definitions_version
+
+    if cache.get(_DEFINITIONS_VERSION_KEY) != _definitions_version:
+        _clear_definitions()
+    _definitions_version = _set_new_version(_DEFINITIONS_VERSION_KEY)
+
+
+def get_graph(workflow):
+    """Returns the CompiledWorkflow for the passed workflow. The graph is
+    loaded from the database the first time it is requested and kept for the
+    lifetime of the process, until it is invalidated by this or another
+    process (see invalidate_graph).
+
+    **Parameters:**
+
+    workflow
+        The workflow to compile. Can be a Workflow instance or a string with
+        the workflow name.
+    """
+    from models import Workflow
+
+    _check_definitions_version()
+    if isinstance(workflow, Workflow):
+        workflow_id = workflow.id
+    else:
+        workflow_id = _graph_ids.get(workflow)
+        if workflow_id is None:
+            try:
+                workflow_id = _graph_ids[workflow] = Workflow.objects.get(name=workflow).id
+            except Workflow.DoesNotExist:
+                return None
+
+    graph = _graphs.get(workflow_id)
+    if graph is not None:
+        return graph
+
+    # the passed instance may be stale, the graph is compiled from the row
+    workflow = get_workflow_by_id(workflow_id)
+    if workflow is None:
+        return None
+    graph = compile_workflow(workflow)
+    with _lock:
+        _graphs[workflow_id] = graph
+    return graph
+
+
+def get_graph_for_state(state):
+    """Returns the CompiledWorkflow which contains the passed state.
+    """
+    _check_definitions_version()
+    for graph in _graphs.values():
+        if state.id in graph.states:
+            return graph
+    return get_graph(state.workflow)
+
+
+def compile_workflow(workflow):
+    """Builds a CompiledWorkflow for the passed Workflow instance.
+    """
+    from models import State, Transition, StatePermissionRelation, WorkflowPermissionRelation
+
+    states = list(State.objects.filter(workflow=workflow).order_by('name'))
+    transitions = list(Transition.objects.filter(workflow=workflow))
+
+    state_transitions = {}
+    relations = State.transitions.through.objects.filter(state__workflow=workflow).values_list(
+        'state', 'transition'
+    )
+    for state_id, transition_id in relations.order_by('transition'):
+        state_transitions.setdefault(state_id, []).append(transition_id)
+
+    permissions = {}
+    state_permissions = {}
+    relations = StatePermissionRelation.objects.filter(state__workflow=workflow).values_list(
+        'state', 'role', 'permission', 'permission__codename'
+    )
+    for state_id, role_id, permission_id, codename in relations:
+        state_permissions.setdefault(state_id, set()).add((role_id, permission_id))
+        permissions[codename] = permission_id
+
+    workflow_permission_ids = []
+    relations = WorkflowPermissionRelation.objects.filter(workflow=workflow).values_list(
+        'permission', 'permission__codename'
+    )
+    for permission_id, codename in relations:
+        workflow_permission_ids.append(permission_id)
+        permissions[codename] = permission_id
+
+    return CompiledWorkflow(
+        workflow, states, transitions, state_transitions, state_permissions, permissions, workflow_permission_ids
+    )
+
+
+def invalidate_graph(workflow_id=None, state_id=None):
+    """Drops compiled workflows from the process cache.
+
+    **Parameters:**
+
+    workflow_id
+        If given only the graph of this workflow is dropped.
+
+    state_id
+        If given only the graph containing this state is dropped.
+
+    If none of them is given every compiled workflow is dropped.
+
+    The version of the workflow definitions in the shared cache is changed
+    too, so the other processes drop all their compiled workflows, Workflow
+    instances and model workflows (see _check_definitions_version).
+    """
+    with _lock:
+        if workflow_id is None and state_id is None:
+            _graphs.clear()
+            _graph_ids.clear()
+        else:
+            for graph_id, graph in _graphs.items():
+                if graph_id == workflow_id or state_id in graph.states:
+                    del _graphs[graph_id]
+    _set_new_definitions_version()
+
+
+# Workflow resolution ########################################################
+
+_model_workflows = {}
+_object_workflows = {}
+_workflows = {}
+
+
+def _object_workflows_version_key(ctype_id):
+    return "WORKFLOWS_OBJECT_WORKFLOWS_VERSION_%s" % ctype_id
+
+
+def get_workflow_by_id(workflow_id):
+    """Returns the Workflow instance with the passed id, which is loaded once
+    per process.
+    """
+    from models import Workflow
+
+    _check_definitions_version()
+    workflow = _workflows.get(workflow_id)
+    if workflow is None:
+        try:
+            workflow = Workflow.objects.select_related('initial_state').get(id=workflow_id)
+        except Workflow.DoesNotExist:
+            return None
+        _workflows[workflow_id] = workflow
+    return workflow
+
+
+def get_model_workflow(model):
+    """Returns the workflow of the passed model (see
+    utils.get_or_create_workflow). The resolution is kept in a process-local
+    dict content type id -> workflow id, and only a missing workflow is
+    created within a transaction. A missing workflow is only kept for the
+    models without workflow settings, so a workflow whose creation failed is
+    looked for again on the next call.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from utils import get_or_create_workflow, get_workflow_for_model
+
+    _check_definitions_version()
+    ctype = ContentType.objects.get_for_model(model)
+    try:
+        workflow_id = _model_workflows[ctype.id]
+    except KeyError:
+        workflow = get_workflow_for_model(ctype) or get_or_create_workflow(model)
+        if workflow is None:
+            if "%s.%s" % (model.__module__, model.__name__) in getattr(settings, 'WORKFLOWS', {}):
+                return None
+            workflow_id = None
+        else:
+            workflow_id = workflow.id
+            _workflows.setdefault(workflow_id, workflow)
+        _model_workflows[ctype.id] = workflow_id
+
+    return get_workflow_by_id(workflow_id) if workflow_id is not None else None
+
+
+def get_object_workflow_id(obj):
+    """Returns the id of the own workflow of the passed object (see
+    WorkflowObjectRelation), or None. The ids of the objects with an own
+    workflow are loaded once per content type into a process-local index,
+    which is reloaded when the version of the content type in the shared cache
+    changes, so the changes made by other processes are seen too (see
+    _get_version and invalidate_workflows).
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from models import WorkflowObjectRelation
+
+    if obj.pk is None:
+        return None
+
+    ctype_id = ContentType.objects.get_for_model(obj).id
+    version = _get_version(_object_workflows_version_key(ctype_id))
+    local_version, overrides = _object_workflows.get(ctype_id, (None, None))
+    if local_version != version:
+        overrides = dict(
+            WorkflowObjectRelation.objects.filter(content_type=ctype_id).values_list('content_id', 'workflow')
+        )
+        _object_workflows[ctype_id] = (version, overrides)
+    return overrides.get(obj.pk)
+
+
+def resolve_workflow(obj):
+    """Returns the workflow for the passed object: its own workflow if it has
+    one, otherwise the workflow of its model.
+
+    Both lookups are served from process-local caches which are kept in sync
+    with the WorkflowModelRelation, WorkflowObjectRelation and Workflow tables
+    through signals, and checked against versions in the shared cache, so the
+    changes made by other processes are seen too (see _get_version).
+    """
+    workflow_id = get_object_workflow_id(obj)
+    if workflow_id is not None:
+        return get_workflow_by_id(workflow_id)
+    return get_model_workflow(obj.__class__)
+
+
+def invalidate_workflows(model_ctype_id=None, object_ctype_id=None):
+    """Drops the cached workflow resolutions.
+
+    **Parameters:**
+
+    model_ctype_id
+        If given only the model workflow of this content type is dropped. The
+        workflow definitions are given a new version in the shared cache, so
+        the other processes reload them.
+
+    object_ctype_id
+        If given only the own workflows of the objects of this content type
+        are dropped. They are given a new version in the shared cache, so the
+        other processes reload them too.
+
+    If none of them is given every resolution and Workflow instance of the
+    process is dropped.
+    """
+    with _lock:
+        if model_ctype_id is None and object_ctype_id is None:
+            _model_workflows.clear()
+            _object_workflows.clear()
+            _workflows.clear()
+        else:
+            _model_workflows.pop(model_ctype_id, None)
+            _object_workflows.pop(object_ctype_id, None)
+    if model_ctype_id is not None:
+        _set_new_definitions_version()
+    if object_ctype_id is not None:
+        _set_new_version(_object_workflows_version_key(object_ctype_id))
+
+
+# Signals ####################################################################
+
+def _invalidate_workflow(sender, instance, **kwargs):
+    # the name of a workflow may have changed, so all graphs are dropped
+    invalidate_graph()
+    invalidate_workflows()
+
+
+def _invalidate_model_workflow(sender, instance, **kwargs):
+    invalidate_workflows(model_ctype_id=instance.content_type_id)
+
+
+def _invalidate_object_workflow(sender, instance, **kwargs):
+    invalidate_workflows(object_ctype_id=instance.content_type_id)
+
+
+def _invalidate_workflow_item(sender, instance, **kwargs):
+    invalidate_graph(workflow_id=instance.workflow_id)
+
+
+def _invalidate_state_item(sender, instance, **kwargs):
+    invalidate_graph(state_id=instance.state_id)
+
+
+def _invalidate_state_transitions(sender, instance, **kwargs):
+    if kwargs.get('action', '').startswith('post_'):
+        invalidate_graph()
+
+
+def connect_signals():
+    """Connects the graph and workflow resolution invalidation to the
+    workflow models.
+    """
+    from models import (
+        Workflow, State, Transition, StatePermissionRelation, WorkflowModelRelation, WorkflowObjectRelation,
+        WorkflowPermissionRelation
+    )
+
+    for signal in (post_save, post_delete):
+        signal.connect(_invalidate_workflow, sender=Workflow, dispatch_uid='workflows.graph.workflow')
+        signal.connect(_invalidate_workflow_item, sender=State, dispatch_uid='workflows.graph.state')
+        signal.connect(_invalidate_workflow_item, sender=Transition, dispatch_uid='workflows.graph.transition')
+        signal.connect(
+            _invalidate_workflow_item, sender=WorkflowPermissionRelation, dispatch_uid='workflows.graph.permission'
+        )
+        signal.connect(
+            _invalidate_state_item, sender=StatePermissionRelation, dispatch_uid='workflows.graph.state_permission'
+        )
+        signal.connect(
+            _invalidate_model_workflow, sender=WorkflowModelRelation, dispatch_uid='workflows.graph.model_workflow'
+        )
+        signal.connect(
+            _invalidate_object_workflow, sender=WorkflowObjectRelation, dispatch_uid='workflows.graph.object_workflow'
+        )
+
+    m2m_changed.connect(
+        _invalidate_state_transitions, sender=State.transitions.through, dispatch_uid='workflows.graph.state_transition'
+    )
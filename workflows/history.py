@@ -0,0 +1,114 @@
+# coding=utf-8
+import threading
+from functools import wraps
+
+from django.db import connections, router
+
+_local = threading.local()
+
+
+def _get_buffers():
+    if not hasattr(_local, 'buffers'):
+        _local.buffers = []
+    return _local.buffers
+
+
+def _get_atomic_depth():
+    """Returns the atomic block depth of the connection of the history (None
+    outside of a transaction).
+    """
+    from models import WorkflowHistorical
+
+    connection = connections[router.db_for_write(WorkflowHistorical)]
+    if not connection.in_atomic_block:
+        return None
+    return len(connection.savepoint_ids)
+
+
+def write_history(entries):
+    """Writes the passed WorkflowHistorical entries with one bulk insert, or
+    adds them to the current history buffer of the thread if there is one and
+    it has been started in the current atomic block (see start_buffer).
+
+    **Parameters:**
+
+    entries
+        A list of unsaved WorkflowHistorical instances.
+    """
+    from models import WorkflowHistorical
+
+    buffers = _get_buffers()
+    if buffers and buffers[-1][0] is not None and buffers[-1][0] == _get_atomic_depth():
+        buffers[-1][1].extend(entries)
+    elif entries:
+        WorkflowHistorical.objects.bulk_create(entries)
+
+
+def start_buffer():
+    """Starts buffering the history entries written by the current thread,
+    until flush_buffer or discard_buffer is called. Buffers can be nested, the
+    entries of a nested buffer are then written by the outermost one.
+
+    Only the entries written in the atomic block in which the buffer has been
+    started are buffered, so that they are written in the same transaction.
+    The entries written in a nested atomic block are written right away, to be
+    rolled back with its savepoint, and a buffer started outside of a
+    transaction doesn't buffer anything.
+    """
+    _get_buffers().append((_get_atomic_depth(), []))
+
+
+def flush_buffer():
+    """Ends the current history buffer and writes its entries with one bulk
+    insert. Note that their update_at is the time of the insert.
+    """
+    depth, entries = _get_buffers().pop()
+    write_history(entries)
+
+
+def discard_buffer():
+    """Ends the current history buffer without writing its entries, for
+    example because the changes they record have been rolled back.
+    """
+    _get_buffers().pop()
+
+
+class BufferedHistory(object):
+    """Context manager and decorator of buffered_history.
+    """
+
+    def __enter__(self):
+        start_buffer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            flush_buffer()
+        else:
+            discard_buffer()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return inner
+
+
+def buffered_history(func=None):
+    """Buffers the history entries written in the block by do_transition and
+    save and writes them with one bulk insert at the end of the block. The
+    entries are discarded if the block raises. Use it inside the transaction
+    of the changes, for example as a decorator of a view with ATOMIC_REQUESTS,
+    so that the history is written and rolled back with them: outside of a
+    transaction nothing is buffered.
+
+    The entries of bulk_create and do_transition_bulk are not buffered, these
+    operations run in their own atomic block and write them right away (see
+    start_buffer).
+
+    Can be used as a context manager (``with buffered_history():``) or as a
+    decorator (``@buffered_history``).
+    """
+    if callable(func):
+        return BufferedHistory()(func)
+    return BufferedHistory()
@@ -0,0 +1,37 @@
+# coding=utf-8
+import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from workflows.models import WorkflowHistorical
+
+
+class Command(BaseCommand):
+    """Moves the old history entries to the archive table (see
+    WorkflowHistoricalManager.archive).
+    """
+    help = 'Moves the workflow history entries older than the given number of days to the archive table.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--days', type='int', dest='days', default=None,
+            help='Age in days of the entries to archive.'
+        ),
+        make_option(
+            '--batch-size', type='int', dest='batch_size', default=None,
+            help='Number of entries moved per batch.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError("The --days option is required")
+        if not getattr(settings, 'WORKFLOWS_HISTORY_ARCHIVE', False):
+            # the archived entries would disappear from the history of the objects
+            raise CommandError("The WORKFLOWS_HISTORY_ARCHIVE setting must be True to archive the history")
+
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        moved = WorkflowHistorical.objects.archive(before, options['batch_size'])
+        self.stdout.write("%s history entries archived" % moved)
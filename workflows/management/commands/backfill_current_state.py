@@ -0,0 +1,46 @@
+# coding=utf-8
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+from workflows.models import WorkflowBase
+from workflows.utils import backfill_current_state
+
+
+class Command(BaseCommand):
+    """Copies the state relations (StateObjectRelation) of the workflow
+    enabled models into their current_state column, before switching the
+    WORKFLOWS_STATE_RELATIONS setting off.
+    """
+    args = '[app_label.ModelName ...]'
+    help = 'Backfills the current_state column of workflow enabled models from their state relations.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', dest='batch_size', default=None,
+            help='Number of state relations handled per batch.'
+        ),
+        make_option(
+            '--delete-relations', action='store_true', dest='delete_relations', default=False,
+            help='Deletes the state relations once copied.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            models = []
+            for label in args:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Models must be given as app_label.ModelName, got '%s'" % label)
+                model = get_model(app_label, model_name)
+                if model is None or not issubclass(model, WorkflowBase):
+                    raise CommandError("'%s' is not a workflow enabled model" % label)
+                models.append(model)
+        else:
+            models = [model for model in get_models() if issubclass(model, WorkflowBase)]
+
+        for model in models:
+            updated = backfill_current_state(model, options['batch_size'], options['delete_relations'])
+            self.stdout.write("%s.%s: %s objects updated" % (model._meta.app_label, model.__name__, updated))
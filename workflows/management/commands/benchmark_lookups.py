@@ -0,0 +1,75 @@
+# coding=utf-8
+import random
+import time
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+
+from workflows.models import State, StateObjectRelation, Workflow, WorkflowHistorical
+from workflows.utils import chunks
+
+
+class Command(BaseCommand):
+    """Measures the cost of the (content_type, content_id) lookups of the
+    state relations and of the history with a synthetic data set.
+
+    To compare the lookups with and without the composite indexes, run it
+    once migrated to 0002 and once migrated to 0003:
+
+        ./manage.py migrate workflows 0002
+        ./manage.py benchmark_lookups --rows 1000000
+        ./manage.py migrate workflows
+        ./manage.py benchmark_lookups --rows 1000000
+
+    The synthetic rows are deleted afterwards.
+    """
+    help = 'Measures the state relation and history lookups by object with a synthetic data set.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--rows', type='int', dest='rows', default=1000000,
+            help='Number of state relations and history entries to create.'
+        ),
+        make_option(
+            '--lookups', type='int', dest='lookups', default=1000,
+            help='Number of lookups measured per query.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        lookups = options['lookups']
+
+        workflow = Workflow.objects.create(name="BENCHMARK_LOOKUPS_WORKFLOW")
+        state = State.objects.create(name="Benchmark", workflow=workflow)
+        ctype, created = ContentType.objects.get_or_create(app_label="workflows", model="benchmarklookups")
+        try:
+            self.stdout.write("Creating %s rows..." % rows)
+            for ids in chunks(range(1, rows + 1)):
+                StateObjectRelation.objects.bulk_create([
+                    StateObjectRelation(content_type=ctype, content_id=pk, state=state) for pk in ids
+                ])
+                WorkflowHistorical.objects.bulk_create([
+                    WorkflowHistorical(content_type=ctype, content_id=pk, state=state) for pk in ids
+                ])
+
+            ids = [random.randint(1, rows) for i in xrange(lookups)]
+            self.measure("State relation by object", ids, lambda pk: StateObjectRelation.objects.get(
+                content_type=ctype, content_id=pk
+            ))
+            self.measure("History by object", ids, lambda pk: list(WorkflowHistorical.objects.filter(
+                content_type=ctype, content_id=pk
+            ).order_by('-update_at')[:10]))
+        finally:
+            StateObjectRelation.objects.filter(content_type=ctype).delete()
+            WorkflowHistorical.objects.filter(content_type=ctype).delete()
+            workflow.delete()
+            if created:
+                ctype.delete()
+
+    def measure(self, name, ids, lookup):
+        start = time.time()
+        for pk in ids:
+            lookup(pk)
+        elapsed = time.time() - start
+        self.stdout.write("%s: %.3f ms per lookup" % (name, elapsed * 1000 / len(ids)))
@@ -0,0 +1,32 @@
+# coding=utf-8
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from workflows.sync import sync_workflows
+
+
+class Command(BaseCommand):
+    """Synchronizes the workflows of the database with the WORKFLOWS setting
+    (see workflows.sync.sync_workflow).
+    """
+    help = 'Creates or updates the workflows defined in the WORKFLOWS setting.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only prints the changes, without applying them.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        if dry_run:
+            self.stdout.write("Dry run, no change is applied.")
+
+        for path, changes in sync_workflows(dry_run):
+            if not changes:
+                self.stdout.write("%s: up to date" % path)
+                continue
+            self.stdout.write("%s:" % path)
+            for change in changes:
+                self.stdout.write("  - %s" % change)
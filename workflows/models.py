@@ -1,18 +1,28 @@
 # coding=utf-8
 import logging
 import inspect
+import graph
+import history
+import roles
+import sync
 import utils
 from collections import Iterable
 from django.conf import settings
 from django.contrib.auth.models import User, Group
-from django.db import models
+from django.db import connections, models
+from django.db.transaction import atomic
+from django.db.backends.util import typecast_timestamp
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_delete
 from django.core.cache import cache
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-import permissions.utils
-from permissions.models import Permission, Role
+from permissions.models import ObjectPermission, Permission, Role
+
+from settings import BULK_BATCH_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -71,28 +81,45 @@ class Workflow(models.Model):
             except IndexError:
                 return None
 
-    def get_objects(self):
-        """Returns all objects which have this workflow assigned. Globally
-        (via the object's content type) or locally (via the object itself).
+    def get_objects(self, chunk_size=None):
+        """Returns a lazy iterator over all objects which have this workflow
+        assigned. Globally (via the object's content type) or locally (via the
+        object itself).
+
+        The objects of each model are streamed in chunks of ``chunk_size``
+        rows (WORKFLOWS_BULK_BATCH_SIZE by default), and the objects whose
+        model workflow is overwritten by another local one are excluded by the
+        database.
         """
-        import utils
-        objs = []
+        model_ctypes = []
 
         # Get all objects whose content type has this workflow
-        for wmr in WorkflowModelRelation.objects.filter(workflow=self):
+        for wmr in WorkflowModelRelation.objects.filter(workflow=self).select_related('content_type').order_by('id'):
             ctype = wmr.content_type
+            model = ctype.model_class()
+            if model is None:
+                continue
+            model_ctypes.append(ctype.id)
+
             # We have also to check whether the global workflow is not
-            # overwritten.
-            for obj in ctype.model_class().objects.all():
-                if utils.get_workflow(obj) == self:
-                    objs.append(obj)
+            # overwritten. The relations without content_id are left out of the
+            # subquery, a NULL would make the NOT IN exclude all the objects.
+            overwritten = WorkflowObjectRelation.objects.filter(
+                content_type=ctype, content_id__isnull=False).exclude(workflow=self)
+            queryset = model._default_manager.exclude(pk__in=overwritten.values('content_id'))
+            for obj in utils.iterate_in_chunks(queryset, chunk_size):
+                yield obj
 
         # Get all objects whose local workflow this workflow
-        for wor in WorkflowObjectRelation.objects.filter(workflow=self):
-            if wor.content not in objs:
-                objs.append(wor.content)
+        wors = WorkflowObjectRelation.objects.filter(workflow=self).exclude(content_type__in=model_ctypes)
+        for ctype_id in wors.order_by('content_type').values_list('content_type', flat=True).distinct():
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            if model is None:
+                continue
 
-        return objs
+            ids = wors.filter(content_type=ctype_id).values('content_id')
+            for obj in utils.iterate_in_chunks(model._default_manager.filter(pk__in=ids), chunk_size):
+                yield obj
 
     def set_to(self, ctype_or_obj):
         """Sets the workflow to passed content type or object. See the specific
@@ -183,42 +210,28 @@ class State(models.Model):
 
     def get_allowed_transitions(self, obj, user):
         """Returns all allowed transitions for passed object and user.
+
+        The transitions come from the compiled workflow graph and the roles of
+        the user from the role cache (see roles.get_role_ids), so at most one
+        query is needed to check the granted permissions.
         """
-        from django.db.models.query import Q
-        from django.contrib.contenttypes.models import ContentType
-        ctype = ContentType.objects.get_for_model(obj)
+        transitions = graph.get_graph_for_state(self).get_transitions(self)
+        permission_ids = set(t.permission_id for t in transitions if t.permission_id is not None)
+        if not permission_ids:
+            return transitions
 
-        roles = Role.objects.filter(
-            Q (
-                principalrolerelation__user=user,
-                principalrolerelation__content_type=None,
-                principalrolerelation__content_id=None
-            ) |
-            Q (
-                principalrolerelation__group__user=user,
-                principalrolerelation__content_type=None,
-                principalrolerelation__content_id=None
-            ) |
-            Q (
-                principalrolerelation__user=user,
-                principalrolerelation__content_type=ctype,
-                principalrolerelation__content_id=obj.id
-            ) |
-            Q (
-                principalrolerelation__group__user=user,
-                principalrolerelation__content_type=ctype,
-                principalrolerelation__content_id=obj.id
-            )
-        ).distinct()
-
-        return self.transitions.filter(
-            Q (permission=None) |
-            Q (
-                permission__objectpermission__content_type=ctype,
-                permission__objectpermission__content_id=obj.id,
-                permission__objectpermission__role__in=roles
-            )
-        ).distinct()
+        role_ids = roles.get_role_ids(user, obj)
+        if not role_ids:
+            return [t for t in transitions if t.permission_id is None]
+
+        granted = set(ObjectPermission.objects.filter(
+            content_type=ContentType.objects.get_for_model(obj),
+            content_id=obj.id,
+            permission__in=permission_ids,
+            role__in=role_ids
+        ).values_list('permission', flat=True))
+
+        return [t for t in transitions if t.permission_id is None or t.permission_id in granted]
 
 
 class Transition(models.Model):
@@ -288,7 +301,8 @@ class StateObjectRelation(models.Model):
         return "%s %s - %s" % (self.content_type.name, self.content_id, self.state.name)
 
     class Meta:
-        unique_together = ("content_type", "content_id", "state")
+        # an object has one state
+        unique_together = ("content_type", "content_id")
 
 
 class WorkflowObjectRelation(models.Model):
@@ -410,19 +424,273 @@ class StatePermissionRelation(models.Model):
         return "%s %s %s" % (self.state.name, self.role.name, self.permission.name)
 
 
+def _dwell_duration_sql(connection):
+    """Returns the SQL of the duration in seconds between the update_at and
+    next_at columns for the backends supporting window functions, otherwise
+    None.
+    """
+    if connection.vendor == 'postgresql':
+        return "EXTRACT(EPOCH FROM (next_at - update_at))"
+    if connection.vendor == 'mysql' and connection.mysql_version >= (8, 0, 2):
+        return "TIMESTAMPDIFF(MICROSECOND, update_at, next_at) / 1000000.0"
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        if Database.sqlite_version_info >= (3, 25, 0):
+            # julianday is only precise to the millisecond
+            return "ROUND((julianday(next_at) - julianday(update_at)) * 86400.0, 3)"
+    return None
+
+
 class WorkflowHistoricalManager(models.Manager):
     """
         WorkflowHistoricalManager class.
     """
 
+    def filter_history(self, content_type=None, since=None, until=None):
+        """Returns the history entries of the passed content type (a
+        ContentType, a model or an instance) updated in [since, until).
+        All parameters are optional.
+        """
+        versions = self.all()
+        if content_type is not None:
+            if not isinstance(content_type, ContentType):
+                content_type = ContentType.objects.get_for_model(content_type)
+            versions = versions.filter(content_type=content_type)
+        if since is not None:
+            versions = versions.filter(update_at__gte=since)
+        if until is not None:
+            versions = versions.filter(update_at__lt=until)
+        return versions
+
+    def get_transition_counts(self, period='day', content_type=None, since=None, until=None):
+        """Returns the number of history entries per time bucket, state and
+        transition, counted with one GROUP BY query. The result is a list of
+        dicts with the keys bucket (the truncated datetime), state (id),
+        transition (id, None for the initial states) and count, ordered by
+        bucket.
+
+        **Parameters:**
+
+        period
+            The size of the buckets: 'year', 'month', 'day', 'hour' or
+            'minute'.
+
+        content_type, since, until
+            See filter_history.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        column = "%s.%s" % (qn(self.model._meta.db_table), qn('update_at'))
+        tzname = timezone.get_current_timezone_name() if settings.USE_TZ else None
+        sql, params = connection.ops.datetime_trunc_sql(period, column, tzname)
+
+        rows = self.filter_history(content_type, since, until).extra(
+            select={'bucket': sql}, select_params=params
+        ).values('bucket', 'state', 'transition').annotate(count=models.Count('id')).order_by(
+            'bucket', 'state', 'transition'
+        )
+
+        result = []
+        for row in rows:
+            bucket = row['bucket']
+            if isinstance(bucket, basestring):
+                bucket = typecast_timestamp(bucket)
+            if settings.USE_TZ and timezone.is_naive(bucket):
+                bucket = timezone.make_aware(bucket, timezone.get_current_timezone())
+            row['bucket'] = bucket
+            result.append(row)
+        return result
+
+    def get_dwell_times(self, content_type=None, since=None, until=None):
+        """Returns the time spent by the objects in each state, as a dict
+        state id -> dict with the number of stays (count) and their total,
+        average, minimum and maximum duration in seconds. A stay lasts from a
+        history entry to the next one of the same object, so the current
+        states of the objects are not counted.
+
+        The durations are computed and aggregated by the database with a
+        window function where the backend supports them (PostgreSQL, MySQL 8,
+        SQLite 3.25), otherwise the history is streamed ordered by object.
+
+        **Parameters:**
+
+        content_type, since, until
+            See filter_history.
+        """
+        versions = self.filter_history(content_type, since, until)
+        connection = connections[self.db]
+        duration = _dwell_duration_sql(connection)
+        if duration is None:
+            return self._get_dwell_times_in_python(versions)
+
+        qn = connection.ops.quote_name
+        columns = dict(
+            (name, "%s.%s" % (qn(self.model._meta.db_table), qn(name)))
+            for name in ('id', 'content_type_id', 'content_id', 'update_at')
+        )
+        lead = (
+            "LEAD(%(update_at)s) OVER (PARTITION BY %(content_type_id)s, %(content_id)s "
+            "ORDER BY %(update_at)s, %(id)s)" % columns
+        )
+        inner, params = versions.extra(select={'next_at': lead}).values_list(
+            'state', 'update_at', 'next_at'
+        ).order_by().query.sql_with_params()
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT state_id, COUNT(*), SUM(duration), MIN(duration), MAX(duration) FROM ("
+            "SELECT state_id, %s AS duration FROM (%s) history WHERE next_at IS NOT NULL"
+            ") durations GROUP BY state_id" % (duration, inner),
+            params
+        )
+        return dict(
+            (state_id, self._get_dwell_time(count, total, minimum, maximum))
+            for state_id, count, total, minimum, maximum in cursor.fetchall()
+        )
+
+    def _get_dwell_times_in_python(self, versions):
+        stays = {}
+        previous = None
+        rows = versions.order_by('content_type', 'content_id', 'update_at', 'id').values_list(
+            'content_type', 'content_id', 'state', 'update_at'
+        )
+        for content_type_id, content_id, state_id, update_at in rows.iterator():
+            if previous is not None and previous[:2] == (content_type_id, content_id):
+                duration = (update_at - previous[3]).total_seconds()
+                stays.setdefault(previous[2], []).append(duration)
+            previous = (content_type_id, content_id, state_id, update_at)
+
+        return dict(
+            (state_id, self._get_dwell_time(len(durations), sum(durations), min(durations), max(durations)))
+            for state_id, durations in stays.items()
+        )
+
+    def _get_dwell_time(self, count, total, minimum, maximum):
+        total = float(total)
+        return {
+            'count': count,
+            'total': total,
+            'average': total / count,
+            'minimum': float(minimum),
+            'maximum': float(maximum),
+        }
+
     def get_history_from_object_query_set(self, obj):
         content_type = ContentType.objects.get_for_model(obj)
         return self.filter(content_type=content_type, content_id=obj.pk)
 
+    def get_history_page(self, obj, limit=20, cursor=None, recent_first=True, since=None):
+        """Returns a page of the history of the passed object, as a tuple
+        (entries, cursor). The entries come with their state, transition and
+        user, and are ordered by (update_at, id). The returned cursor is the
+        one to pass to get the next page, or None if it's the last one.
+
+        The pages are selected with the cursor (keyset pagination) instead of
+        an offset, so that each page costs the same whatever its position.
+
+        **Parameters:**
+
+        obj
+            The object for which the history is returned.
+
+        limit
+            The maximum number of entries of the page.
+
+        cursor
+            The cursor returned with the previous page, None for the first one.
+
+        recent_first
+            If True the most recent entries come first.
+
+        since
+            If given, only the entries updated at or after this datetime are
+            returned.
+        """
+        sources = [self.get_history_from_object_query_set(obj)]
+        if getattr(settings, 'WORKFLOWS_HISTORY_ARCHIVE', False):
+            # the archived entries are older than the live ones
+            archived = WorkflowHistoricalArchive.objects.filter(
+                content_type=ContentType.objects.get_for_model(obj), content_id=obj.pk
+            )
+            if recent_first:
+                sources.append(archived)
+            else:
+                sources.insert(0, archived)
+
+        # one more entry tells whether there is a next page
+        entries = []
+        for versions in sources:
+            versions = versions.select_related('state', 'transition', 'user')
+            if since is not None:
+                versions = versions.filter(update_at__gte=since)
+            if recent_first:
+                versions = versions.order_by('-update_at', '-id')
+            else:
+                versions = versions.order_by('update_at', 'id')
+
+            if cursor is not None:
+                update_at, pk = cursor
+                if recent_first:
+                    versions = versions.filter(
+                        models.Q(update_at__lt=update_at) | models.Q(update_at=update_at, id__lt=pk)
+                    )
+                else:
+                    versions = versions.filter(
+                        models.Q(update_at__gt=update_at) | models.Q(update_at=update_at, id__gt=pk)
+                    )
+
+            entries.extend(versions[:limit + 1 - len(entries)])
+            if len(entries) > limit:
+                break
+
+        if len(entries) > limit:
+            entries = entries[:limit]
+            return entries, (entries[-1].update_at, entries[-1].id)
+        return entries, None
+
+    def iterate_history(self, obj, recent_first=True, since=None, chunk_size=None):
+        """Iterates over the history of the passed object fetching
+        ``chunk_size`` entries (the WORKFLOWS_BULK_BATCH_SIZE setting by
+        default) per query, so that only one chunk is held in memory at a time.
+        See get_history_page for the other parameters.
+        """
+        cursor = None
+        while True:
+            entries, cursor = self.get_history_page(obj, chunk_size or BULK_BATCH_SIZE, cursor, recent_first, since)
+            for entry in entries:
+                yield entry
+            if cursor is None:
+                break
+
     def get_elements_for_user(self, obj, user):
         content_type = ContentType.objects.get_for_model(obj)
         return self.filter(content_type=content_type, content_id=obj.id, user=user)
 
+    def archive(self, before, batch_size=None):
+        """Moves the history entries updated before the passed datetime to the
+        archive table (see WorkflowHistoricalArchive), keeping their ids, with
+        one transaction per batch. Returns the number of moved entries.
+
+        **Parameters:**
+
+        before
+            The entries updated before this datetime are moved.
+
+        batch_size
+            The number of entries moved per batch. Defaults to the
+            WORKFLOWS_BULK_BATCH_SIZE setting.
+        """
+        attnames = [field.attname for field in self.model._meta.concrete_fields]
+        moved = 0
+        for pks in utils.iterate_pks_in_chunks(self.filter(update_at__lt=before), batch_size):
+            with atomic():
+                WorkflowHistoricalArchive.objects.bulk_create([
+                    WorkflowHistoricalArchive(**values) for values in self.filter(pk__in=pks).values(*attnames)
+                ])
+                self.filter(pk__in=pks).delete()
+            moved += len(pks)
+        return moved
+
 
 class WorkflowHistorical(models.Model):
     """ Model class to save the historic of workflow.
@@ -473,6 +741,39 @@ class WorkflowHistorical(models.Model):
 
     objects = WorkflowHistoricalManager()
 
+    class Meta:
+        # the history of an object is looked up by object and ordered by date,
+        # the reports filter by content type and date
+        index_together = (("content_type", "content_id", "update_at"), ("content_type", "update_at"))
+
+
+class WorkflowHistoricalArchive(models.Model):
+    """Stores the history entries moved out of WorkflowHistorical (see
+    WorkflowHistoricalManager.archive), so that the live table only holds the
+    recent history. The entries keep their ids and dates, and are read with
+    the live ones by the history of the objects if the
+    WORKFLOWS_HISTORY_ARCHIVE setting is True.
+
+    See WorkflowHistorical for the attributes.
+    """
+    id = models.IntegerField(primary_key=True)
+    content_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_(u"Content type"),
+        related_name="content_type_set_for_%(class)s"
+    )
+    content_id = models.PositiveIntegerField(_(u"Content id"))
+    content = generic.GenericForeignKey('content_type', 'content_id')
+
+    user = models.ForeignKey(User, verbose_name=_(u"User"), null=True, blank=True)
+    state = models.ForeignKey(State, verbose_name=_(u"Current state"))
+    transition = models.ForeignKey(Transition, verbose_name=_(u"Transition"), blank=True, null=True)
+    update_at = models.DateTimeField(_(u"Update at"))
+    comment = models.TextField(_(u"User comment"), null=True, blank=True)
+
+    class Meta:
+        index_together = (("content_type", "content_id", "update_at"),)
+
 
 class WorkflowBase(models.Model):
     """Mixin class to make objects workflow aware.
@@ -481,38 +782,71 @@ class WorkflowBase(models.Model):
     class Meta(object):
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(WorkflowBase, self).__init__(*args, **kwargs)
+        self._loaded_values = self._get_field_values()
+
+    def _get_field_values(self):
+        """Returns a dict attname -> value of the loaded (not deferred) fields.
+        """
+        values = {}
+        for field in self._meta.concrete_fields:
+            if field.attname in self.__dict__:
+                values[field.attname] = self.__dict__[field.attname]
+        return values
+
+    def get_dirty_fields(self):
+        """Returns the set of attnames of the fields which changed since the
+        instance was loaded or saved.
+        """
+        loaded = self._loaded_values
+        values = self._get_field_values()
+        return set(
+            attname for attname, value in values.items() if attname not in loaded or loaded[attname] != value
+        )
+
     @classmethod
     def workflow(cls):
-        return utils.get_or_create_workflow(cls)
+        """Returns the workflow of the model, resolved once per process (see
+        graph.get_model_workflow).
+        """
+        return graph.get_model_workflow(cls)
 
     @classmethod
     def states(cls):
-        try:
-            return cls.workflow().states.all()
-        except:
-            return State.objects.none()
+        """Returns the list of the states of the workflow of the model,
+        ordered by name, taken from the compiled workflow graph.
+        """
+        workflow = cls.workflow()
+        if workflow is None:
+            return []
+        return sorted(graph.get_graph(workflow).states.values(), key=lambda state: state.name)
 
     @classmethod
     def final_states(cls):
-        return cls.states().filter(transitions=None)
+        """Returns the states without outgoing transitions (see states).
+        """
+        workflow = cls.workflow()
+        if workflow is None:
+            return []
+        workflow_graph = graph.get_graph(workflow)
+        return [state for state in cls.states() if not workflow_graph.state_transitions.get(state.id)]
 
     @classmethod
     def active_states(cls):
-        return cls.states().exclude(transitions=None)
+        """Returns the states with outgoing transitions (see states).
+        """
+        workflow = cls.workflow()
+        if workflow is None:
+            return []
+        workflow_graph = graph.get_graph(workflow)
+        return [state for state in cls.states() if workflow_graph.state_transitions.get(state.id)]
 
     def get_workflow(self):
-        """Returns the current workflow of the object.
+        """Returns the current workflow of the object (see
+        graph.resolve_workflow).
         """
-        # build cache key
-        key = ("%s_%s" % (self.__class__.__name__, "WORKFLOW")).upper()
-        workflow = cache.get(key)
-        if workflow is not None:
-            return workflow
-
-        workflow = utils.get_workflow(self)
-        if workflow:
-            cache.set(key, workflow)
-        return workflow
+        return graph.resolve_workflow(self)
 
     def remove_workflow(self):
         """Removes the workflow from the object. After this function has been
@@ -543,22 +877,25 @@ class WorkflowBase(models.Model):
     def get_state(self):
         """Returns the current workflow state of the object.
         """
-        return self.current_state or utils.get_state(self)
+        return utils.get_current_state(self)
 
     def get_state_name(self):
         """Returns the current workflow state name of the object.
         """
-        return str(self.current_state or utils.get_state(self))
+        return str(utils.get_current_state(self))
 
     def set_state(self, state):
-        """Sets the workflow state of the object.
+        """Sets the workflow state of the object. The state relation and the
+        permissions are updated by save, if the state changed.
         """
-        return utils.set_state(self, state)
+        self.current_state = state
+        if self.pk:
+            self.save(update_fields=['current_state'])
 
     def set_initial_state(self):
         """Sets the initial state of the current workflow to the object.
         """
-        return self.set_state(self.get_workflow().initial_state)
+        return self.set_state(graph.get_graph(self.get_workflow()).get_initial_state())
 
     def get_allowed_transitions(self, user):
         """Returns allowed transitions for the current state.
@@ -569,35 +906,45 @@ class WorkflowBase(models.Model):
         """Processes the passed transition (if allowed).
         """
         if not isinstance(transition, Transition):
-            try:
-                transition = Transition.objects.get(name=transition, workflow=self.get_workflow())
-            except Transition.DoesNotExist:
+            workflow = self.get_workflow()
+            transition = graph.get_graph(workflow).get_transition(transition) if workflow else None
+            if transition is None:
                 return False
 
-        success = utils.do_transition(self, transition, user)
-        if success:
-            # update current state
-            self.current_state = transition.destination
-            self.save()
-
-            # save history
-            WorkflowHistorical.objects.create(
-                content_type=self.get_content_type(),
-                content_id=self.pk,
-                state=transition.destination,
-                transition=transition,
-                user=user,
-                comment=comment
-            )
-        return success
+        if transition not in self.get_allowed_transitions(user):
+            return False
+
+        # update current state (save updates the state relation and the permissions)
+        state = graph.get_graph(self.get_workflow()).states.get(transition.destination_id)
+        self.current_state = state or transition.destination
+        self.save()
+
+        # save history
+        history.write_history([WorkflowHistorical(
+            content_type=self.get_content_type(),
+            content_id=self.pk,
+            state=self.current_state,
+            transition=transition,
+            user=user,
+            comment=comment
+        )])
+        return True
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, comment=u"", user=None):
         """
-        Overriding the model save method in order to save the initial history workflow
+        Overriding the model save method in order to save the initial history workflow. For existing instances
+        the state relation and permissions are only updated if the current state changed, and the user roles
+        only if a field they depend on changed (see get_dirty_fields)
         """
         new_instance = True if not self.pk else False
         if new_instance:
-            self.current_state = self.get_workflow().initial_state
+            workflow = self.get_workflow()
+            self.current_state = graph.get_graph(workflow).get_initial_state() if workflow else None
+            dirty = set()
+        else:
+            dirty = self.get_dirty_fields()
+            if update_fields is not None:
+                dirty.intersection_update(self._get_attnames(update_fields))
 
         try:
             models.Model.save(self, force_insert, force_update, using, update_fields)
@@ -606,19 +953,30 @@ class WorkflowBase(models.Model):
             logger.error(e.message)
         finally:
             if self.pk:
-                if new_instance:
-                    self.set_initial_state()
-                    # save history
-                    WorkflowHistorical.objects.create(
-                        content_type=self.get_content_type(),
-                        content_id=self.pk,
-                        state=self.current_state,
-                        user=user,
-                        comment=comment
-                    )
+                if new_instance and self.current_state is not None:
+                    utils.init_workflow_state_bulk(self.__class__, [self], workflow, self.current_state, user, comment)
+                elif 'current_state_id' in dirty:
+                    utils.set_state(self, self.current_state)
 
                 # fix user roles
-                self.fix_user_roles()
+                user_roles_fields = self.get_user_roles_fields()
+                if new_instance or user_roles_fields is None or user_roles_fields.intersection(dirty):
+                    self.fix_user_roles(created=new_instance)
+
+                values = self._get_field_values()
+                if update_fields is not None and not new_instance:
+                    saved = self._get_attnames(update_fields)
+                    values = dict((k, v) for k, v in values.items() if k in saved)
+                self._loaded_values.update(values)
+
+    def _get_attnames(self, field_names):
+        """Returns the attnames of the passed field names (or attnames).
+        """
+        attnames = set()
+        for field in self._meta.concrete_fields:
+            if field.name in field_names or field.attname in field_names:
+                attnames.add(field.attname)
+        return attnames
 
     def get_content_type(self):
         """
@@ -634,56 +992,167 @@ class WorkflowBase(models.Model):
         cache.set(key, content_type)
         return content_type
 
-    def fix_user_roles(self):
+    def fix_user_roles(self, created=False):
         """
         Fix the user roles with self instance defined in the workflow settings
         """
+        self.fix_user_roles_bulk([self], created)
+
+    @classmethod
+    def fix_user_roles_bulk(cls, objs, created=False):
+        """
+        Fix the user roles of the passed instances defined in the workflow settings. The wanted (principal, role)
+        pairs are compared with the existing role relations, fetched with one query per batch (skipped for
+        created instances, which have none), and only the missing ones are inserted, with one bulk insert
+        """
+        from permissions.models import PrincipalRoleRelation
+
+        wanted = set()
+        for obj in objs:
+            wanted.update((obj.pk,) + item for item in obj._get_user_roles())
+        if not wanted:
+            return
+
+        role_ids = roles.get_role_ids_by_name(set(role for content_id, user_id, group_id, role in wanted))
+        ctype = ContentType.objects.get_for_model(cls)
+
+        existing = set()
+        if not created:
+            for ids in utils.chunks(list(set(content_id for content_id, user_id, group_id, role in wanted))):
+                existing.update(PrincipalRoleRelation.objects.filter(
+                    content_type=ctype,
+                    content_id__in=ids,
+                    role__in=role_ids.values()
+                ).values_list('content_id', 'user', 'group', 'role'))
+
+        missing = [
+            PrincipalRoleRelation(
+                user_id=user_id, group_id=group_id, role_id=role_ids[role], content_type=ctype, content_id=content_id
+            )
+            for content_id, user_id, group_id, role in wanted
+            if (content_id, user_id, group_id, role_ids[role]) not in existing
+        ]
+        if missing:
+            PrincipalRoleRelation.objects.bulk_create(missing)
+            # bulk_create doesn't send the signals which keep the role cache in sync
+            roles.invalidate_roles(set(relation.user_id for relation in missing if relation.user_id))
+            group_ids = set(relation.group_id for relation in missing if relation.group_id)
+            if group_ids:
+                roles.invalidate_roles(User.objects.filter(groups__in=group_ids).values_list('id', flat=True))
+
+    @classmethod
+    def get_user_roles_spec(cls):
+        """
+        Returns the user_roles of the workflow settings of the model, compiled once per class into a tuple of
+        (attributes, role name, id attname, principal class) items. The id attname and principal class are only
+        set for user paths which are a foreign key to User or Group, whose id is read without loading the object
+        """
+        spec = cls.__dict__.get('_user_roles_spec')
+        if spec is not None:
+            return spec
+
         workflows = getattr(settings, 'WORKFLOWS', {})
-        wf_name = self.get_workflow().name
-        model_path = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
+        model_path = "%s.%s" % (cls.__module__, cls.__name__)
         # finding workflow settings
         wf_item = workflows.get(model_path, None)
+
+        spec = []
         if wf_item:
+            wf_name = utils.get_wf_dict_value(wf_item, 'name', model_path)
             user_roles = utils.get_wf_dict_value(wf_item, 'user_roles', wf_name)
             for user_role in user_roles:
                 user_path = utils.get_wf_dict_value(user_role, 'user_path', wf_name, 'user_roles')
                 role = utils.get_wf_dict_value(user_role, 'role', wf_name, 'user_roles')
 
-                attributes = user_path.split('.')
-                target = self
-                for attr in attributes:
+                attributes = tuple(user_path.split('.'))
+                attname = principal_class = None
+                if len(attributes) == 1:
                     try:
-                        target = getattr(target, attr)
-                    except AttributeError:
-                        target = None
-                        break
-                else:
-                    if not target:
-                        continue  # go to the next user_role
+                        field = cls._meta.get_field(attributes[0])
+                    except FieldDoesNotExist:
+                        pass
+                    else:
+                        if isinstance(field, models.ForeignKey) and field.rel.to in (User, Group):
+                            attname, principal_class = field.attname, field.rel.to
+                spec.append((attributes, role, attname, principal_class))
+
+        spec = tuple(spec)
+        cls._user_roles_spec = spec
+        return spec
 
-                if inspect.ismethod(target):
-                    target = target()
+    @classmethod
+    def get_user_roles_fields(cls):
+        """
+        Returns the attnames of the fields the user roles of the workflow settings depend on (the first attribute
+        of each user path), or None if a user path doesn't start with a concrete field (a method, property or
+        many to many field), whose changes can't be detected, in which case the roles are fixed on every save
+        """
+        attnames = dict((field.name, field.attname) for field in cls._meta.concrete_fields)
+        fields = set()
+        for attributes, role, attname, principal_class in cls.get_user_roles_spec():
+            if attributes[0] not in attnames:
+                return None
+            fields.add(attnames[attributes[0]])
+        return fields
 
-                # add (user or group) role relation
-                if isinstance(target, Iterable):
-                    for item in target:
-                        self._add_user_group_role(item, Role.objects.get(name=role))
+    def _get_user_roles(self):
+        """
+        Returns the (user id, group id, role name) items defined by the user_roles of the workflow settings
+        """
+        result = []
+        for attributes, role, attname, principal_class in self.get_user_roles_spec():
+            if attname is not None:
+                principal_id = getattr(self, attname)
+                if principal_id:
+                    result.append((principal_id, None, role) if principal_class is User else (None, principal_id, role))
+                continue
+
+            target = self
+            for attr in attributes:
+                try:
+                    target = getattr(target, attr)
+                except AttributeError:
+                    target = None
+                    break
+            else:
+                if not target:
+                    continue  # go to the next user_role
+
+            if inspect.ismethod(target):
+                target = target()
+
+            # (user or group) role relation
+            for item in target if isinstance(target, Iterable) else [target]:
+                if isinstance(item, User):
+                    result.append((item.pk, None, role))
+                elif isinstance(item, Group):
+                    result.append((None, item.pk, role))
                 else:
-                    self._add_user_group_role(target, Role.objects.get(name=role))
+                    raise TypeError('Expected a django User or Group instance.')
+        return result
 
-    def _add_user_group_role(self, target, role):
-        if isinstance(target, User) or isinstance(target, Group):
-            permissions.utils.add_local_role(self, target, role)
-        else:
-            raise TypeError('Expected a django User or Group instance.')
+    def history(self, recent_first=True, since=None, chunk_size=None):
+        """Iterates over the history of the object, fetched in chunks (see
+        WorkflowHistoricalManager.iterate_history).
+        """
+        return WorkflowHistorical.objects.iterate_history(self, recent_first, since, chunk_size)
+
+    def reverse_history(self, since=None, chunk_size=None):
+        return self.history(False, since, chunk_size)
+
+    def history_page(self, limit=20, cursor=None, recent_first=True, since=None):
+        """Returns a page of the history of the object and the cursor of the
+        next page (see WorkflowHistoricalManager.get_history_page).
+        """
+        return WorkflowHistorical.objects.get_history_page(self, limit, cursor, recent_first, since)
+
+
+def _delete_workflow_rows(sender, instance, **kwargs):
+    if isinstance(instance, WorkflowBase):
+        utils.delete_workflow_rows_bulk(sender, [instance.pk])
 
-    def history(self, recent_first=True):
-        versions = WorkflowHistorical.objects.get_history_from_object_query_set(self)
-        if recent_first:
-            versions = versions.order_by('-update_at')
-        else:
-            versions = versions.order_by('update_at')
-        return (version for version in versions)
 
-    def reverse_history(self):
-        return self.history(recent_first=False)
\ No newline at end of file
+post_delete.connect(_delete_workflow_rows, dispatch_uid='workflows.models.delete_workflow_rows')
+graph.connect_signals()
+roles.connect_signals()
+sync.connect_signals()
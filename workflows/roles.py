@@ -0,0 +1,187 @@
+# coding=utf-8
+import uuid
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from permissions.models import PrincipalRoleRelation, Role
+
+
+def _version_key(user_id):
+    return "WORKFLOWS_ROLES_VERSION_%s" % user_id
+
+
+def _get_version(user_id):
+    """Returns the current version of the cached roles of the passed user.
+    """
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(key, version)
+    return version
+
+
+def invalidate_roles(user_ids):
+    """Invalidates the cached roles of the passed users, by giving them a new
+    version. The entries of the old version are never read again and expire
+    on their own.
+
+    **Parameters:**
+
+    user_ids
+        An iterable of user ids.
+    """
+    cache.set_many(dict((_version_key(user_id), uuid.uuid4().hex) for user_id in user_ids))
+
+
+def get_global_role_ids(user):
+    """Returns a frozenset with the ids of the global roles of the passed user
+    (directly or via its groups).
+
+    **Parameters:**
+
+    user
+        The user for which the roles are returned.
+    """
+    if user.pk is None:
+        return frozenset()
+
+    key = "WORKFLOWS_ROLES_%s_%s" % (user.pk, _get_version(user.pk))
+    role_ids = cache.get(key)
+    if role_ids is None:
+        role_ids = frozenset(PrincipalRoleRelation.objects.filter(
+            Q(user=user) | Q(group__user=user),
+            content_type=None,
+            content_id=None
+        ).values_list('role', flat=True))
+        cache.set(key, role_ids)
+    return role_ids
+
+
+def get_local_role_ids_bulk(user, objs):
+    """Returns the ids of the local roles of the passed user (directly or via
+    its groups) for each of the passed objects, as a dict object pk -> frozenset
+    of role ids. Only the objects which are not cached yet are fetched, with
+    one query.
+
+    **Parameters:**
+
+    user
+        The user for which the roles are returned.
+
+    objs
+        The objects for which the local roles are returned. Django model
+        instances of the same model.
+    """
+    if user.pk is None:
+        return dict((obj.pk, frozenset()) for obj in objs)
+
+    version = _get_version(user.pk)
+    keys = {}
+    for obj in objs:
+        ctype = ContentType.objects.get_for_model(obj)
+        keys["WORKFLOWS_ROLES_%s_%s_%s_%s" % (user.pk, version, ctype.id, obj.pk)] = (ctype, obj.pk)
+
+    cached = cache.get_many(keys.keys())
+    result = dict((keys[key][1], role_ids) for key, role_ids in cached.items())
+
+    missing = {}
+    for key, (ctype, pk) in keys.items():
+        if key not in cached:
+            missing.setdefault(ctype, {})[pk] = key
+    if missing:
+        content_filter = Q()
+        for ctype, pks in missing.items():
+            content_filter |= Q(content_type=ctype, content_id__in=pks.keys())
+
+        fetched = {}
+        relations = PrincipalRoleRelation.objects.filter(
+            Q(user=user) | Q(group__user=user)
+        ).filter(content_filter).values_list('role', 'content_type', 'content_id')
+        for role_id, ctype_id, content_id in relations:
+            fetched.setdefault((ctype_id, content_id), set()).add(role_id)
+
+        to_cache = {}
+        for ctype, pks in missing.items():
+            for pk, key in pks.items():
+                result[pk] = to_cache[key] = frozenset(fetched.get((ctype.id, pk), ()))
+        cache.set_many(to_cache)
+
+    return result
+
+
+_role_ids = {}
+
+
+def get_role_ids_by_name(names):
+    """Returns a dict role name -> role id for the passed role names. The ids
+    are kept in a process-local dict, so only unknown names are queried.
+    Raises Role.DoesNotExist if a role doesn't exist.
+
+    **Parameters:**
+
+    names
+        An iterable of role names.
+    """
+    names = set(names)
+    missing = names.difference(_role_ids)
+    if missing:
+        _role_ids.update(Role.objects.filter(name__in=missing).values_list('name', 'id'))
+        for name in missing.difference(_role_ids):
+            raise Role.DoesNotExist('Role matching query does not exist: %s' % name)
+    return dict((name, _role_ids[name]) for name in names)
+
+
+def get_role_ids(user, obj):
+    """Returns a frozenset with the ids of the global roles of the passed user
+    and its local roles for the passed object.
+    """
+    return get_global_role_ids(user) | get_local_role_ids_bulk(user, [obj])[obj.pk]
+
+
+# Signals ####################################################################
+
+def _invalidate_role(sender, instance, **kwargs):
+    _role_ids.clear()
+
+
+def _invalidate_principal_role(sender, instance, **kwargs):
+    if instance.user_id is not None:
+        invalidate_roles([instance.user_id])
+    if instance.group_id is not None:
+        invalidate_roles(User.objects.filter(groups=instance.group_id).values_list('id', flat=True))
+
+
+def _invalidate_new_user(sender, instance, created=False, raw=False, **kwargs):
+    # the id may belong to a deleted user whose roles are still cached
+    if created:
+        invalidate_roles([instance.id])
+
+
+def _invalidate_group_members(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            invalidate_roles([instance.id])
+    elif action == 'pre_clear':
+        # the members of the group are not known anymore after the clear
+        invalidate_roles(instance.user_set.values_list('id', flat=True))
+    elif action.startswith('post_') and pk_set:
+        invalidate_roles(pk_set)
+
+
+def connect_signals():
+    """Connects the role cache invalidation to the role and group models.
+    """
+    for signal in (post_save, post_delete):
+        signal.connect(_invalidate_role, sender=Role, dispatch_uid='workflows.roles.role')
+        signal.connect(
+            _invalidate_principal_role, sender=PrincipalRoleRelation, dispatch_uid='workflows.roles.principal_role'
+        )
+    post_save.connect(_invalidate_new_user, sender=User, dispatch_uid='workflows.roles.user')
+    m2m_changed.connect(
+        _invalidate_group_members, sender=User.groups.through, dispatch_uid='workflows.roles.group_members'
+    )
@@ -1 +1,5 @@
-# coding=utf-8
\ No newline at end of file
+# coding=utf-8
+from django.conf import settings as _settings
+
+# Number of objects handled by each statement of the bulk operations
+BULK_BATCH_SIZE = getattr(_settings, 'WORKFLOWS_BULK_BATCH_SIZE', 500)
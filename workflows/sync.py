@@ -0,0 +1,246 @@
+# coding=utf-8
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.transaction import atomic
+from django.utils.module_loading import import_by_path
+
+from permissions.models import ObjectPermission, Permission, Role
+
+import utils
+
+
+def sync_workflows(dry_run=False):
+    """Synchronizes the workflows of the database with the WORKFLOWS setting
+    (see sync_workflow). Returns a list of (model path, list of changes).
+
+    **Parameters:**
+
+    dry_run
+        If True the changes are only returned, not applied.
+    """
+    result = []
+    for path, wf_item in sorted(getattr(settings, 'WORKFLOWS', {}).items()):
+        result.append((path, sync_workflow(import_by_path(path), wf_item, dry_run)))
+    return result
+
+
+@atomic
+def sync_workflow(model, wf_item, dry_run=False):
+    """Synchronizes the workflow of the passed model with the passed
+    definition (an item of the WORKFLOWS setting), and returns the list of the
+    changes, as strings. Only the differences are written, with one bulk
+    statement per table.
+
+    The workflow is created if the model has none. Otherwise the missing
+    roles, permissions, states and transitions are created, the changed
+    ones updated, and the permission and transition relations of the states
+    are made to match the definition. The objects in the states whose
+    permissions changed get the new ones (see utils.update_permissions_bulk),
+    and the object permissions of the permissions removed from the workflow
+    are deleted. The states and transitions which are not in the definition
+    anymore are kept, since objects and history may still refer to them, and
+    are only reported.
+
+    The compiled graph of the workflow is invalidated in every process (see
+    graph.invalidate_graph).
+
+    **Parameters:**
+
+    model
+        The model of the workflow.
+
+    wf_item
+        The definition of the workflow (see parse_workflow_definition).
+
+    dry_run
+        If True the changes are only returned, not applied.
+    """
+    from graph import invalidate_graph
+    from models import (
+        State, StateObjectRelation, StatePermissionRelation, Transition, WorkflowPermissionRelation
+    )
+
+    definition = utils.parse_workflow_definition(wf_item)
+    ctype = ContentType.objects.get_for_model(model)
+    workflow = utils.get_workflow_for_model(ctype)
+    if workflow is None:
+        if not dry_run:
+            utils.create_workflow(model, definition)
+        return [u"create workflow %s" % definition['name']]
+
+    changes = []
+    if workflow.name != definition['name']:
+        changes.append(u"rename workflow %s to %s" % (workflow.name, definition['name']))
+
+    # ROLES AND PERMISSIONS
+    existing = set(Role.objects.filter(name__in=definition['roles']).values_list('name', flat=True))
+    changes.extend(u"create role %s" % role for role in sorted(set(definition['roles']) - existing))
+    existing = set(Permission.objects.filter(
+        codename__in=definition['permissions'].keys()
+    ).values_list('codename', flat=True))
+    changes.extend(
+        u"create permission %s" % permission for permission in sorted(set(definition['permissions']) - existing)
+    )
+
+    # STATES
+    states = dict(State.objects.filter(workflow=workflow).values_list('name', 'alias'))
+    new_states = sorted(set(definition['states']) - set(states))
+    changed_states = sorted(
+        name for name, alias in definition['states'].items() if name in states and states[name] != alias
+    )
+    changes.extend(u"create state %s" % name for name in new_states)
+    changes.extend(u"update state %s" % name for name in changed_states)
+    changes.extend(
+        u"state %s is not in the settings (not deleted)" % name
+        for name in sorted(set(states) - set(definition['states']))
+    )
+
+    initial_state = workflow.initial_state.name if workflow.initial_state_id else None
+    if initial_state != definition['initial_state']:
+        changes.append(u"set initial state %s" % definition['initial_state'])
+
+    # TRANSITIONS
+    transitions = dict(
+        (values[0], values[1:]) for values in Transition.objects.filter(workflow=workflow).values_list(
+            'name', 'destination__name', 'permission__codename', 'description', 'condition'
+        )
+    )
+    new_transitions = sorted(set(definition['transitions']) - set(transitions))
+    changed_transitions = sorted(
+        name for name, values in definition['transitions'].items()
+        if name in transitions and transitions[name] != values
+    )
+    changes.extend(u"create transition %s" % name for name in new_transitions)
+    changes.extend(u"update transition %s" % name for name in changed_transitions)
+    changes.extend(
+        u"transition %s is not in the settings (not deleted)" % name
+        for name in sorted(set(transitions) - set(definition['transitions']))
+    )
+
+    # RELATIONS
+    state_permissions = dict(
+        (values[1:], values[0]) for values in StatePermissionRelation.objects.filter(
+            state__workflow=workflow
+        ).values_list('id', 'state__name', 'role__name', 'permission__codename')
+    )
+    new_state_permissions = sorted(definition['state_permissions'] - set(state_permissions))
+    old_state_permissions = sorted(set(state_permissions) - definition['state_permissions'])
+    changes.extend(u"grant %s to %s in state %s" % (p, r, s) for s, r, p in new_state_permissions)
+    changes.extend(u"revoke %s from %s in state %s" % (p, r, s) for s, r, p in old_state_permissions)
+    # the objects in these states hold the permissions of the old relations
+    permission_states = sorted(
+        set(s for s, r, p in new_state_permissions + old_state_permissions) - set(new_states)
+    )
+    changes.extend(u"update the permissions of the objects in state %s" % s for s in permission_states)
+
+    workflow_permissions = dict(
+        (codename, pk) for pk, codename in WorkflowPermissionRelation.objects.filter(
+            workflow=workflow
+        ).values_list('id', 'permission__codename')
+    )
+    new_workflow_permissions = sorted(set(definition['permissions']) - set(workflow_permissions))
+    old_workflow_permissions = sorted(set(workflow_permissions) - set(definition['permissions']))
+    changes.extend(u"add permission %s to the workflow" % p for p in new_workflow_permissions)
+    changes.extend(u"remove permission %s from the workflow" % p for p in old_workflow_permissions)
+
+    through = State.transitions.through
+    state_transitions = dict(
+        (values[1:], values[0]) for values in through.objects.filter(
+            state__workflow=workflow
+        ).values_list('id', 'state__name', 'transition__name')
+    )
+    new_state_transitions = sorted(definition['state_transitions'] - set(state_transitions))
+    old_state_transitions = sorted(set(state_transitions) - definition['state_transitions'])
+    changes.extend(u"add transition %s to state %s" % (t, s) for s, t in new_state_transitions)
+    changes.extend(u"remove transition %s from state %s" % (t, s) for s, t in old_state_transitions)
+
+    if dry_run or not changes:
+        return changes
+
+    dict_roles = utils.get_or_create_roles(definition['roles'])
+    dict_permissions = utils.get_or_create_permissions(definition['permissions'])
+
+    State.objects.bulk_create([
+        State(name=name, alias=definition['states'][name], workflow=workflow) for name in new_states
+    ])
+    for name in changed_states:
+        State.objects.filter(workflow=workflow, name=name).update(alias=definition['states'][name])
+    dict_states = dict((state.name, state) for state in State.objects.filter(workflow=workflow))
+
+    def get_transition_values(name):
+        destination, permission, description, condition = definition['transitions'][name]
+        return {
+            'destination': dict_states[destination],
+            'permission': dict_permissions[permission],
+            'description': description,
+            'condition': condition,
+        }
+
+    Transition.objects.bulk_create([
+        Transition(name=name, workflow=workflow, **get_transition_values(name)) for name in new_transitions
+    ])
+    for name in changed_transitions:
+        Transition.objects.filter(workflow=workflow, name=name).update(**get_transition_values(name))
+    dict_transitions = dict(
+        (transition.name, transition) for transition in Transition.objects.filter(workflow=workflow)
+    )
+
+    StatePermissionRelation.objects.filter(
+        id__in=[state_permissions[key] for key in old_state_permissions]
+    ).delete()
+    StatePermissionRelation.objects.bulk_create([
+        StatePermissionRelation(state=dict_states[s], role=dict_roles[r], permission=dict_permissions[p])
+        for s, r, p in new_state_permissions
+    ])
+
+    WorkflowPermissionRelation.objects.filter(
+        id__in=[workflow_permissions[key] for key in old_workflow_permissions]
+    ).delete()
+    if old_workflow_permissions:
+        ObjectPermission.objects.filter(
+            content_type=ctype,
+            role__name__in=definition['roles'],
+            permission__codename__in=old_workflow_permissions
+        ).delete()
+    WorkflowPermissionRelation.objects.bulk_create([
+        WorkflowPermissionRelation(workflow=workflow, permission=dict_permissions[p])
+        for p in new_workflow_permissions
+    ])
+
+    through.objects.filter(id__in=[state_transitions[key] for key in old_state_transitions]).delete()
+    through.objects.bulk_create([
+        through(state=dict_states[s], transition=dict_transitions[t]) for s, t in new_state_transitions
+    ])
+
+    if workflow.name != definition['name'] or initial_state != definition['initial_state']:
+        workflow.name = definition['name']
+        workflow.initial_state = dict_states[definition['initial_state']]
+        workflow.save()
+
+    # the bulk statements don't send the signals which keep the compiled graph in sync
+    invalidate_graph(workflow.id)
+
+    for name in permission_states:
+        state = dict_states[name]
+        if utils.uses_state_relations(model):
+            ids = StateObjectRelation.objects.filter(content_type=ctype, state=state).values_list(
+                'content_id', flat=True
+            )
+        else:
+            ids = model._base_manager.filter(current_state=state).values_list('pk', flat=True)
+        utils.update_permissions_bulk(model, list(ids), workflow, state)
+    return changes
+
+
+def _sync_after_migrate(sender, app=None, **kwargs):
+    if app == 'workflows':
+        sync_workflows()
+
+
+def connect_signals():
+    """Synchronizes the workflows after the migrations of the workflows app if
+    the WORKFLOWS_SYNC_ON_MIGRATE setting is True.
+    """
+    if getattr(settings, 'WORKFLOWS_SYNC_ON_MIGRATE', False):
+        from south.signals import post_migrate
+        post_migrate.connect(_sync_after_migrate, dispatch_uid='workflows.sync')
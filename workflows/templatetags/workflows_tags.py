@@ -4,7 +4,7 @@
 from django import template
 
 # workflows imports
-from ..utils import get_allowed_transitions, get_state
+from ..utils import get_allowed_transitions, get_current_state
 from workflows.models import WorkflowBase
 
 register = template.Library()
@@ -18,7 +18,7 @@ def transitions(context, obj):
     
     return {
         "transitions": get_allowed_transitions(obj, request.user),
-        "state": obj.current_state or get_state(obj),
+        "state": get_current_state(obj),
     }
 
 @register.assignment_tag
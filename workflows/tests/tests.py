@@ -1,17 +1,27 @@
 # coding=utf-8
+import copy
+import datetime
+from StringIO import StringIO
 
 # django imports
+from django.conf import settings
+from django.db import connection
+from django.db.transaction import atomic
+from django.test.utils import CaptureQueriesContext
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.flatpages.models import FlatPage
-from django.test import TestCase
-from django.contrib.auth.models import User
+from django.test import TestCase as BaseTestCase
+from django.contrib.auth.models import Group, User
 from django.contrib.sessions.backends.file import SessionStore
 from django.core.handlers.wsgi import WSGIRequest
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test.client import Client
 
 # workflows import
 import permissions.utils
 from workflows import utils
+from permissions.models import ObjectPermission, Permission, Role
 from workflows.models import (
     Workflow,
     WorkflowModelRelation,
@@ -20,11 +30,27 @@ from workflows.models import (
     State,
     StatePermissionRelation,
     StateObjectRelation,
-    Transition
+    Transition,
+    WorkflowHistorical,
+    WorkflowHistoricalArchive
 )
+from workflows import roles
+from workflows import graph
+from workflows.graph import get_graph
+from workflows.history import buffered_history
 from workflows.tests.models import Publication
 
 
+class TestCase(BaseTestCase):
+    """Drops the process-local workflow caches before each test, as they
+    don't see the rollback of the previous test.
+    """
+    def _pre_setup(self):
+        super(TestCase, self)._pre_setup()
+        graph.invalidate_graph()
+        graph.invalidate_workflows()
+
+
 # Extended of django-workflow tests and adapted to django-wflow
 class WorkflowTestCase(TestCase):
     """Tests a simple workflow without permissions.
@@ -225,53 +251,82 @@ class UtilsTestCase(TestCase):
     def test_get_objects_for_workflow_1(self):
         """Workflow is added to object.
         """
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication])
 
         utils.set_workflow(self.user, self.workflow)
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication, self.user])
 
     def test_get_objects_for_workflow_2(self):
         """Workflow is added to content type.
         """
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication])
 
         ctype = ContentType.objects.get_for_model(self.user)
         utils.set_workflow(ctype, self.workflow)
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication, self.publication.owner, self.user])
 
     def test_get_objects_for_workflow_3(self):
         """Workflow is added to content type and object.
         """
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication])
 
         utils.set_workflow(self.user, self.workflow)
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication, self.user])
 
         ctype = ContentType.objects.get_for_model(self.user)
         utils.set_workflow(ctype, self.workflow)
-        result = utils.get_objects_for_workflow(self.workflow)
+        result = list(utils.get_objects_for_workflow(self.workflow))
         self.assertEqual(result, [self.publication, self.publication.owner, self.user])
 
     def test_get_objects_for_workflow_4(self):
         """Get workflow by name
         """
-        result = utils.get_objects_for_workflow("PUBLICATION_WORKFLOW")
+        result = list(utils.get_objects_for_workflow("PUBLICATION_WORKFLOW"))
         self.assertEqual(result, [self.publication])
 
         utils.set_workflow(self.user, self.workflow)
-        result = utils.get_objects_for_workflow("PUBLICATION_WORKFLOW")
+        result = list(utils.get_objects_for_workflow("PUBLICATION_WORKFLOW"))
         self.assertEqual(result, [self.publication, self.user])
 
         # Workflow which does not exist
-        result = utils.get_objects_for_workflow("Wrong")
+        result = list(utils.get_objects_for_workflow("Wrong"))
         self.assertEqual(result, [])
 
+    def test_get_objects_for_workflow_5(self):
+        """Objects are streamed in chunks and local overrides are excluded
+        """
+        publications = [self.publication] + [
+            Publication.objects.create(name="Publication %s" % i, owner=self.user) for i in range(4)
+        ]
+        result = self.workflow.get_objects(chunk_size=2)
+        self.assertEqual(list(result), publications)
+
+        portal = Workflow.objects.create(name="Portal")
+        portal.initial_state = State.objects.create(name="Draft", workflow=portal)
+        portal.save()
+        utils.set_workflow_for_object(publications[1], portal)
+        result = utils.get_objects_for_workflow(self.workflow)
+        self.assertEqual(list(result), publications[:1] + publications[2:])
+
+    def test_get_objects_for_workflow_6(self):
+        """A relation without content id doesn't exclude the other objects
+        """
+        ctype = ContentType.objects.get_for_model(self.publication)
+        portal = Workflow.objects.create(name="Portal")
+        WorkflowObjectRelation.objects.create(content_type=ctype, content_id=None, workflow=portal)
+
+        result = list(utils.get_objects_for_workflow(self.workflow))
+        self.assertEqual(result, [self.publication])
+
+        utils.remove_workflow_from_model(ctype)
+        self.assertEqual(StateObjectRelation.objects.filter(content_type=ctype).count(), 0)
+
     def test_remove_workflow_from_model(self):
         """
         """
@@ -296,6 +351,31 @@ class UtilsTestCase(TestCase):
         result = utils.get_workflow_for_object(self.user)
         self.assertEqual(result, None)
 
+    def test_remove_workflow_from_model_in_batches(self):
+        """
+        """
+        for i in range(4):
+            Publication.objects.create(name="Publication %s" % i, owner=self.user)
+        ctype = ContentType.objects.get_for_model(self.publication)
+
+        portal = Workflow.objects.create(name="Portal")
+        portal.initial_state = State.objects.create(name="Draft", workflow=portal)
+        portal.save()
+        utils.set_workflow_for_object(self.publication, portal)
+
+        progress = []
+        utils.remove_workflow_from_model(ctype, batch_size=3, callback=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress, [(3, 4), (4, 4)])
+
+        result = utils.get_workflow_for_model(ctype)
+        self.assertEqual(result, None)
+
+        # the publication with an own workflow keeps its state
+        self.assertEqual(StateObjectRelation.objects.filter(content_type=ctype).count(), 1)
+        self.assertEqual(utils.get_state(self.publication), portal.initial_state)
+        for publication in Publication.objects.exclude(pk=self.publication.pk):
+            self.assertEqual(permissions.utils.has_permission(publication, self.user, "view"), False)
+
     def test_remove_workflow_from_object(self):
         """
         """
@@ -550,6 +630,40 @@ class WorkflowManagerTestCase(TestCase):
         self.assertEqual(Publication.objects.public().count(), 1)
         self.assertEqual(Publication.objects.private().count(), 4)
 
+    def test_managers_filter_by_state_id(self):
+        public = self.publication_1.get_workflow().states.get(name="Public")
+        other_public = State.objects.create(name="Public", workflow=Workflow.objects.create(name="OTHER"))
+        Publication.objects.filter(pk=self.publication_2.pk).update(current_state=other_public)
+
+        queryset = Publication.objects.public()
+        self.assertNotIn("workflows_state", str(queryset.query))
+        self.assertIn("current_state_id", str(queryset.query))
+        self.assertEqual(queryset.count(), 0)
+
+        self.publication_1.do_make_public(self.publication_1.owner)
+        self.assertEqual(list(Publication.objects.public()), [self.publication_1])
+        self.assertEqual(self.publication_1.current_state, public)
+        self.assertEqual(Publication.objects.private().count(), 3)
+        self.assertEqual(Publication._meta.get_field('current_state').db_index, True)
+
+    def test_state_counts(self):
+        self.publication_1.do_make_public(self.publication_1.owner)
+        self.publication_3.do_make_public(self.publication_3.owner)
+        Publication.objects.filter(pk=self.publication_5.pk).update(current_state=None)
+
+        with self.assertNumQueries(1):
+            counts = Publication.objects.state_counts()
+        self.assertEqual(counts, {"Private": 2, "Public": 2, None: 1})
+        self.assertEqual(Publication.objects.filter(name="Publication 2").state_counts(), {"Private": 1, "Public": 0})
+
+    def test_state_counts_cache(self):
+        self.assertEqual(Publication.objects.state_counts(cache_timeout=60), {"Private": 5, "Public": 0})
+
+        self.publication_1.do_make_public(self.publication_1.owner)
+        with self.assertNumQueries(0):
+            self.assertEqual(Publication.objects.state_counts(cache_timeout=60), {"Private": 5, "Public": 0})
+        self.assertEqual(Publication.objects.state_counts(), {"Private": 4, "Public": 1})
+
 
 class WorkflowCheckerMethodsTestCase(TestCase):
 
@@ -628,6 +742,921 @@ class WorkflowClassMethodsTestCase(TestCase):
 
         self.assertEqual(set(Publication.active_states()).difference(self.publication.get_workflow().states.exclude(transitions=None)), set([]))
 
+    def test_classmethods_without_queries(self):
+        workflow = self.publication.get_workflow()
+        Publication.states()
+        with self.assertNumQueries(0):
+            self.assertEqual(Publication.workflow(), workflow)
+            self.assertEqual([state.name for state in Publication.states()], ["Private", "Public"])
+            self.assertEqual(Publication.final_states(), [])
+            self.assertEqual([state.name for state in Publication.active_states()], ["Private", "Public"])
+
+        archived = State.objects.create(name="Archived", workflow=Publication.workflow())
+        self.assertEqual(Publication.final_states(), [archived])
+
+    def test_classmethods_without_workflow(self):
+        Workflow.objects.all().delete()
+        with self.settings(WORKFLOWS={}):
+            self.assertEqual(Publication.workflow(), None)
+            self.assertEqual(Publication.states(), [])
+            self.assertEqual(Publication.final_states(), [])
+            self.assertEqual(Publication.active_states(), [])
+
+    def test_failed_workflow_creation(self):
+        Workflow.objects.all().delete()
+        get_or_create_workflow = utils.get_or_create_workflow
+        utils.get_or_create_workflow = lambda model: None
+        try:
+            self.assertEqual(Publication.workflow(), None)
+        finally:
+            utils.get_or_create_workflow = get_or_create_workflow
+        # the failure is not cached
+        self.assertEqual(Publication.workflow().name, "PUBLICATION_WORKFLOW")
+
+
+class CompiledWorkflowTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.workflow = self.publication.get_workflow()
+
+        self.private = State.objects.get(name="Private")
+        self.public = State.objects.get(name="Public")
+
+    def test_graph(self):
+        graph = get_graph(self.workflow)
+        self.assertEqual(graph.name, "PUBLICATION_WORKFLOW")
+        self.assertEqual(graph.get_initial_state(), self.private)
+        self.assertEqual(graph.get_state("Public"), self.public)
+        self.assertEqual(graph.get_transitions(self.private), [Transition.objects.get(name="Make public")])
+        self.assertEqual(get_graph("PUBLICATION_WORKFLOW"), graph)
+        self.assertEqual(get_graph("Wrong"), None)
+
+    def test_state_properties_without_queries(self):
+        self.assertEqual(self.publication.is_private, True)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.publication.is_private, True)
+            self.assertEqual(self.publication.is_public, False)
+
+    def test_invalidation(self):
+        graph = get_graph(self.workflow)
+        self.assertEqual(get_graph(self.workflow), graph)
+
+        pending = State.objects.create(name="Pending", workflow=self.workflow)
+        graph = get_graph(self.workflow)
+        self.assertEqual(graph.get_state("Pending"), pending)
+
+        make_pending = Transition.objects.create(name="Make pending", workflow=self.workflow, destination=pending)
+        self.private.transitions.add(make_pending)
+        graph = get_graph(self.workflow)
+        self.assertEqual(len(graph.get_transitions(self.private)), 2)
+
+        make_pending.delete()
+        self.assertEqual(get_graph(self.workflow).get_transition("Make pending"), None)
+
+    def test_permission_matrix(self):
+        owner = Role.objects.get(name="Owner")
+        anonymous = Role.objects.get(name="Anonymous")
+        view = Permission.objects.get(codename="view")
+        edit = Permission.objects.get(codename="edit")
+
+        graph = get_graph(self.workflow)
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.get_permissions(self.private), frozenset([view.id, edit.id]))
+            self.assertEqual(graph.get_permissions(self.public, owner), frozenset([view.id]))
+            self.assertEqual(graph.get_permissions(self.public, anonymous), frozenset())
+            self.assertEqual(graph.get_roles(self.private, "edit"), frozenset([owner.id]))
+            self.assertEqual(graph.get_roles(self.public, edit), frozenset())
+            self.assertEqual(graph.has_permission(self.public, owner, "view"), True)
+            self.assertEqual(graph.has_permission(self.public.id, owner.id, edit.id), False)
+            self.assertEqual(graph.workflow_permission_ids, frozenset([view.id, edit.id]))
+
+        StatePermissionRelation.objects.create(state=self.public, role=anonymous, permission=view)
+        self.assertEqual(get_graph(self.workflow).get_roles(self.public, "view"), frozenset([owner.id, anonymous.id]))
+
+
+class WorkflowResolutionTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.publication_2 = Publication.objects.create(name="Publication 2", owner=self.publication.owner)
+        self.workflow = self.publication.get_workflow()
+
+        self.portal = Workflow.objects.create(name="Portal")
+        self.portal.initial_state = State.objects.create(name="Draft", workflow=self.portal)
+        self.portal.save()
+
+    def test_object_workflow(self):
+        self.assertEqual(self.publication_2.get_workflow(), self.workflow)
+
+        self.publication_2.set_workflow(self.portal)
+        self.assertEqual(self.publication_2.get_workflow(), self.portal)
+        self.assertEqual(self.publication.get_workflow(), self.workflow)
+
+        WorkflowObjectRelation.objects.all().delete()
+        self.assertEqual(self.publication_2.get_workflow(), self.workflow)
+
+    def test_graph_of_other_process(self):
+        get_graph(self.workflow)
+        private = State.objects.get(name="Private")
+        # the graphs of another process, which doesn't receive the signals of this one
+        stale = dict(graph._graphs), graph._definitions_version, dict(graph._versions)
+
+        private.alias = "Draft"
+        private.save()
+        graph._graphs.update(stale[0])
+        graph._definitions_version = stale[1]
+        graph._versions.update(stale[2])
+        self.assertNotEqual(get_graph(self.workflow).get_state("Private").alias, "Draft")
+        with self.settings(WORKFLOWS_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(get_graph(self.workflow).get_state("Private").alias, "Draft")
+
+    def test_workflow_of_other_process(self):
+        stale_workflow = Publication.workflow()
+        get_graph(stale_workflow)
+        public = State.objects.get(name="Public")
+        # the caches of another process, which doesn't receive the signals of this one
+        caches = (graph._graphs, graph._graph_ids, graph._workflows, graph._model_workflows, graph._versions)
+        stale = [dict(item) for item in caches], graph._definitions_version
+
+        workflow = Workflow.objects.get(pk=stale_workflow.pk)
+        workflow.name = "RENAMED"
+        workflow.initial_state = public
+        workflow.save()
+        for item, values in zip(caches, stale[0]):
+            item.update(values)
+        graph._definitions_version = stale[1]
+
+        with self.settings(WORKFLOWS_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(Publication.workflow().name, "RENAMED")
+            self.assertEqual(get_graph(stale_workflow).get_initial_state(), public)
+            self.assertEqual(get_graph("RENAMED").get_initial_state(), public)
+
+    def test_object_workflow_of_other_process(self):
+        self.assertEqual(self.publication_2.get_workflow(), self.workflow)
+        # the index of another process, which doesn't receive the signals of this one
+        stale = dict(graph._object_workflows), dict(graph._versions)
+
+        self.publication_2.set_workflow(self.portal)
+        graph._object_workflows.update(stale[0])
+        graph._versions.update(stale[1])
+        # the shared version is only read once per interval
+        self.assertEqual(self.publication_2.get_workflow(), self.workflow)
+        with self.settings(WORKFLOWS_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(self.publication_2.get_workflow(), self.portal)
+
+    def test_model_workflow(self):
+        ctype = ContentType.objects.get_for_model(self.publication)
+        utils.set_workflow_for_model(ctype, self.portal)
+        self.assertEqual(self.publication.get_workflow(), self.portal)
+
+    def test_cached(self):
+        self.publication.get_workflow()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.publication.get_workflow(), self.workflow)
+            self.assertEqual(self.publication_2.get_workflow(), self.workflow)
+
+
+class CreationTestCase(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        create_publication()
+
+    def test_create(self):
+        # insert of the object, state relation, permissions, history and owner
+        # role
+        with self.assertNumQueries(5):
+            publication = Publication.objects.create(name="Publication", owner=self.owner)
+
+        private = State.objects.get(name="Private")
+        self.assertEqual(publication.current_state, private)
+        self.assertEqual(utils.get_state(publication), private)
+        self.assertEqual(permissions.utils.has_permission(publication, self.owner, "edit"), True)
+        self.assertEqual([h.state for h in publication.history()], [private])
+
+    def test_reused_id(self):
+        publication = Publication.objects.create(name="Publication", owner=self.owner)
+        pk = publication.pk
+        publication.do_make_public(self.owner)
+        publication.delete()
+
+        # sqlite reuses the id of the last deleted row
+        other = User.objects.create(username="other")
+        publication = Publication.objects.create(name="Other", owner=other)
+        self.assertEqual(publication.pk, pk)
+        self.assertEqual(permissions.utils.get_local_roles(publication, self.owner), [])
+        self.assertEqual(permissions.utils.get_local_roles(publication, other), [Role.objects.get(name="Owner")])
+        private = State.objects.get(name="Private")
+        self.assertEqual(utils.get_state(publication), private)
+        self.assertEqual(set(ObjectPermission.objects.filter(
+            content_type=ContentType.objects.get_for_model(publication), content_id=pk
+        ).values_list("permission__codename", flat=True)), set(["view", "edit"]))
+
+
+class UserRolesTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.owner_role = Role.objects.get(name="Owner")
+
+    def test_spec(self):
+        self.assertEqual(Publication.get_user_roles_spec(), ((("owner",), "Owner", "owner_id", User),))
+        self.assertEqual(Publication.get_user_roles_fields(), set(["owner_id"]))
+
+    def test_save(self):
+        user = User.objects.create(username="new owner")
+        self.publication.owner = user
+
+        # the owner field is not saved
+        with self.assertNumQueries(1):
+            self.publication.save(update_fields=["name"])
+        self.assertEqual(permissions.utils.get_local_roles(self.publication, user), [])
+
+        self.publication.save(update_fields=["owner"])
+        self.assertEqual(permissions.utils.get_local_roles(self.publication, user), [self.owner_role])
+
+        # nothing changed
+        with self.assertNumQueries(1):
+            self.publication.save()
+
+    def test_save_with_related_path(self):
+        definition = copy.deepcopy(settings.WORKFLOWS)
+        definition["workflows.tests.models.Publication"]["user_roles"] = [
+            {"user_path": "owner.groups.all", "role": "Owner"}
+        ]
+        group = Group.objects.create(name="Editors")
+        user = User.objects.create(username="new owner")
+        user.groups.add(group)
+
+        with self.settings(WORKFLOWS=definition):
+            del Publication._user_roles_spec
+            try:
+                self.assertEqual(Publication.get_user_roles_fields(), set(["owner_id"]))
+
+                self.publication.owner = user
+                self.publication.save(update_fields=["owner"])
+                self.assertEqual(permissions.utils.get_local_roles(self.publication, group), [self.owner_role])
+
+                definition["workflows.tests.models.Publication"]["user_roles"].append(
+                    {"user_path": "get_content_type", "role": "Owner"}
+                )
+                del Publication._user_roles_spec
+                self.assertEqual(Publication.get_user_roles_fields(), None)
+            finally:
+                del Publication._user_roles_spec
+
+
+class DirtyFieldsTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.public = State.objects.get(name="Public")
+
+    def test_dirty_fields(self):
+        publication = Publication.objects.get(pk=self.publication.pk)
+        self.assertEqual(publication.get_dirty_fields(), set())
+
+        publication.name = "Changed"
+        self.assertEqual(publication.get_dirty_fields(), set(["name"]))
+        publication.save()
+        self.assertEqual(publication.get_dirty_fields(), set())
+
+        publication.name = "Changed again"
+        publication.current_state = self.public
+        publication.save(update_fields=["name"])
+        self.assertEqual(publication.get_dirty_fields(), set(["current_state_id"]))
+
+        deferred = Publication.objects.only("name").get(pk=self.publication.pk)
+        self.assertEqual(deferred.get_dirty_fields(), set())
+
+    def test_content_edit(self):
+        self.publication.name = "Changed"
+        with self.assertNumQueries(1):
+            self.publication.save()
+
+    def test_state_change(self):
+        self.publication.current_state = self.public
+        self.publication.save()
+
+        self.assertEqual(utils.get_state(self.publication), self.public)
+        self.assertEqual(permissions.utils.has_permission(self.publication, self.publication.owner, "edit"), False)
+        self.assertEqual(permissions.utils.has_permission(self.publication, self.publication.owner, "view"), True)
+
+
+class IncrementalPermissionsTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.owner = self.publication.owner
+        self.public = State.objects.get(name="Public")
+        self.ctype = ContentType.objects.get_for_model(self.publication)
+
+    def get_object_permissions(self):
+        return set(ObjectPermission.objects.filter(
+            content_type=self.ctype, content_id=self.publication.id
+        ).values_list("id", "permission__codename"))
+
+    def test_diff(self):
+        before = self.get_object_permissions()
+        self.publication.do_make_public(self.owner)
+        after = self.get_object_permissions()
+
+        # the view permission row is kept, the edit one is removed
+        self.assertEqual(set(codename for pk, codename in after), set(["view"]))
+        self.assertEqual(after.issubset(before), True)
+
+        self.publication.do_make_private(self.owner)
+        self.assertEqual(set(codename for pk, codename in self.get_object_permissions()), set(["view", "edit"]))
+
+    def test_same_permissions(self):
+        utils.set_state(self.publication, self.public)
+        before = self.get_object_permissions()
+
+        # state relation lookup and update, object permissions lookup, nothing written
+        with self.assertNumQueries(3):
+            utils.set_state(self.publication, self.public)
+        self.assertEqual(self.get_object_permissions(), before)
+
+    def test_deleted_state_permission(self):
+        StatePermissionRelation.objects.filter(
+            state__name="Private", role__name="Owner", permission__codename="edit"
+        ).delete()
+
+        # the row granted by the deleted relation is removed by the next transition
+        self.publication.do_make_public(self.owner)
+        self.assertEqual(set(codename for pk, codename in self.get_object_permissions()), set(["view"]))
+        self.publication.do_make_private(self.owner)
+        self.assertEqual(set(codename for pk, codename in self.get_object_permissions()), set(["view"]))
+
+    def test_duplicate_permissions(self):
+        view = ObjectPermission.objects.filter(content_type=self.ctype, content_id=self.publication.id)[0]
+        view.pk = None
+        view.save()
+
+        utils.update_permissions(self.publication)
+        self.assertEqual(len(self.get_object_permissions()), 2)
+
+
+class BulkCreateTestCase(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.other = User.objects.create(username="other")
+        create_publication()
+        self.private = State.objects.get(name="Private")
+
+    def test_bulk_create(self):
+        publications = Publication.objects.bulk_create([
+            Publication(name="Publication %s" % i, owner=self.owner if i % 2 else self.other) for i in range(5)
+        ], comment="import")
+
+        self.assertEqual(Publication.objects.private().count(), 6)
+        self.assertEqual(WorkflowHistorical.objects.filter(comment="import").count(), 5)
+        for publication in publications:
+            self.assertEqual(publication.current_state, self.private)
+            self.assertEqual(utils.get_state(publication), self.private)
+            self.assertEqual(permissions.utils.has_permission(publication, publication.owner, "edit"), True)
+            self.assertEqual(len(publication.get_allowed_transitions(publication.owner)), 1)
+
+    def test_bulk_create_queries(self):
+        objs = [Publication(name="Publication %s" % i, owner=self.owner) for i in range(20)]
+        # savepoint, insert of the objects, read back of their ids, inserts of
+        # the state relations, permissions and history, lookup and insert of
+        # the roles, savepoint release
+        with self.assertNumQueries(9):
+            publications = Publication.objects.bulk_create(objs)
+
+        pks = Publication.objects.filter(name__startswith="Publication ").values_list("pk", flat=True)
+        self.assertEqual([publication.pk for publication in publications], list(pks.order_by("pk")))
+        names = Publication.objects.filter(pk__in=[publications[0].pk, publications[-1].pk]).order_by("pk")
+        self.assertEqual(list(names.values_list("name", flat=True)), ["Publication 0", "Publication 19"])
+
+    def test_fix_user_roles_bulk(self):
+        publications = Publication.objects.bulk_create([Publication(name="Publication", owner=self.owner)])
+        owner = Role.objects.get(name="Owner")
+        self.assertEqual(permissions.utils.get_local_roles(publications[0], self.owner), [owner])
+
+        # existing relations are not duplicated
+        with self.assertNumQueries(1):
+            Publication.fix_user_roles_bulk(publications)
+        self.assertEqual(permissions.utils.get_local_roles(publications[0], self.owner), [owner])
+
+
+class AllowedTransitionsBulkTestCase(TestCase):
+
+    def setUp(self):
+        self.publications = [
+            Publication.objects.create(name="Publication %s" % i, owner=User.objects.create(username="user_%s" % i))
+            for i in range(5)
+        ]
+        self.publications[0].do_make_public(self.publications[0].owner)
+        self.user = self.publications[1].owner
+
+    def test_get_allowed_transitions_bulk(self):
+        result = utils.get_allowed_transitions_bulk(self.publications, self.user)
+        self.assertEqual(set(result.keys()), set(p.pk for p in self.publications))
+
+        for publication in self.publications:
+            self.assertEqual(
+                result[publication.pk],
+                list(publication.current_state.get_allowed_transitions(publication, self.user))
+            )
+
+        # only the owner of the second publication can make it public
+        self.assertEqual([t.name for t in result[self.publications[1].pk]], ["Make public"])
+        self.assertEqual(result[self.publications[2].pk], [])
+
+    def test_query_count(self):
+        utils.get_allowed_transitions_bulk(self.publications[:1], self.user)
+        with self.assertNumQueries(2):
+            utils.get_allowed_transitions_bulk(self.publications, self.user)
+
+    def test_prefetched_result(self):
+        result = utils.get_allowed_transitions_bulk(self.publications, self.user)
+        with self.assertNumQueries(0):
+            for publication in self.publications:
+                self.assertEqual(publication.get_allowed_transitions(self.user), result[publication.pk])
+
+        # a state change discards the prefetched result
+        self.publications[1].do_make_public(self.user)
+        self.assertEqual(
+            [t.name for t in self.publications[1].get_allowed_transitions(self.user)], ["Make private"]
+        )
+
+
+class WithAllowedTransitionsTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(5):
+            Publication.objects.create(name="Publication %s" % i, owner=User.objects.create(username="user_%s" % i))
+        self.user = User.objects.get(username="user_1")
+
+    def test_with_allowed_transitions(self):
+        publications = Publication.objects.private().with_allowed_transitions(self.user)
+        self.assertEqual(len(publications), 5)
+
+        with self.assertNumQueries(0):
+            for publication in publications:
+                transitions = [t.name for t in publication.get_allowed_transitions(self.user)]
+                self.assertEqual(transitions, ["Make public"] if publication.owner_id == self.user.pk else [])
+
+    def test_query_count(self):
+        list(Publication.objects.all()[:1].with_allowed_transitions(self.user))
+        with self.assertNumQueries(3):
+            for publication in Publication.objects.with_allowed_transitions(self.user).filter(name__startswith="P"):
+                publication.get_allowed_transitions(self.user)
+
+    def test_values(self):
+        names = Publication.objects.with_allowed_transitions(self.user).values_list("name", flat=True)
+        self.assertEqual(len(names), 5)
+
+
+class TransitionBulkTestCase(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.other = User.objects.create(username="other")
+        for i in range(4):
+            Publication.objects.create(name="Publication %s" % i, owner=self.owner)
+        Publication.objects.create(name="Publication 4", owner=self.other)
+
+        self.private = State.objects.get(name="Private")
+        self.public = State.objects.get(name="Public")
+
+    def test_do_transition_bulk(self):
+        result = utils.do_transition_bulk(Publication.objects.all(), "Make public", self.owner, batch_size=3)
+
+        other_publication = Publication.objects.get(owner=self.other)
+        self.assertEqual(result[other_publication.pk], False)
+        self.assertEqual(len([success for success in result.values() if success]), 4)
+
+        self.assertEqual(Publication.objects.public().count(), 4)
+        self.assertEqual(Publication.objects.private().get(), other_publication)
+
+        for publication in Publication.objects.public():
+            self.assertEqual(utils.get_state(publication), self.public)
+            self.assertEqual(permissions.utils.has_permission(publication, self.owner, "edit"), False)
+            self.assertEqual(permissions.utils.has_permission(publication, self.owner, "view"), True)
+            self.assertEqual([h.transition for h in publication.reverse_history()][1].name, "Make public")
+
+        self.assertEqual(utils.get_state(other_publication), self.private)
+        self.assertEqual(permissions.utils.has_permission(other_publication, self.other, "edit"), True)
+
+    def test_instances(self):
+        publications = list(Publication.objects.filter(owner=self.owner))
+        result = Publication.objects.none().do_transition_bulk("Make public", self.owner)
+        self.assertEqual(result, {})
+
+        result = utils.do_transition_bulk(publications, "Make public", self.owner, comment="bulk")
+        self.assertEqual(all(result.values()), True)
+        for publication in publications:
+            self.assertEqual(publication.current_state, self.public)
+            self.assertEqual(publication.is_public, True)
+
+        self.assertEqual(WorkflowHistorical.objects.filter(comment="bulk").count(), 4)
+
+    def test_wrong_transition(self):
+        result = Publication.objects.do_transition_bulk("Make pending", self.owner)
+        self.assertEqual(set(result.values()), set([False]))
+        self.assertEqual(Publication.objects.public().count(), 0)
+
+
+class RoleCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.user = User.objects.create(username="editor")
+        self.group = Group.objects.create(name="Editors")
+        self.editor = permissions.utils.register_role("Editor")
+        self.private = State.objects.get(name="Private")
+
+        edit = Permission.objects.get(codename="edit")
+        permissions.utils.grant_permission(self.publication, self.editor, edit)
+
+    def test_global_roles(self):
+        self.assertEqual(roles.get_global_role_ids(self.user), frozenset())
+        self.assertEqual(self.private.get_allowed_transitions(self.publication, self.user), [])
+
+        permissions.utils.add_role(self.group, self.editor)
+        self.user.groups.add(self.group)
+        self.assertEqual(roles.get_global_role_ids(self.user), frozenset([self.editor.id]))
+        self.assertEqual(len(self.private.get_allowed_transitions(self.publication, self.user)), 1)
+
+        self.group.user_set.clear()
+        self.assertEqual(roles.get_global_role_ids(self.user), frozenset())
+
+    def test_local_roles(self):
+        permissions.utils.add_local_role(self.publication, self.user, self.editor)
+        self.assertEqual(roles.get_role_ids(self.user, self.publication), frozenset([self.editor.id]))
+        get_graph(self.publication.get_workflow())
+
+        # only the granted permissions are queried once the roles are cached
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.private.get_allowed_transitions(self.publication, self.user)), 1)
+
+        permissions.utils.remove_local_role(self.publication, self.user, self.editor)
+        self.assertEqual(roles.get_role_ids(self.user, self.publication), frozenset())
+
+
+class StateStorageTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.owner = self.publication.owner
+        self.private = State.objects.get(name="Private")
+        self.public = State.objects.get(name="Public")
+        self.ctype = ContentType.objects.get_for_model(Publication)
+
+    def get_state_relations(self):
+        return StateObjectRelation.objects.filter(content_type=self.ctype)
+
+    def test_current_state_only(self):
+        self.publication.delete()
+        self.get_state_relations().delete()
+        with self.settings(WORKFLOWS_STATE_RELATIONS=False):
+            publication = Publication.objects.create(name="Standard", owner=self.owner)
+            self.assertEqual(utils.uses_state_relations(Publication), False)
+            self.assertEqual(utils.uses_state_relations(FlatPage), True)
+            self.assertEqual(utils.get_state(publication), self.private)
+
+            self.assertEqual(publication.do_make_public(self.owner), True)
+            self.assertEqual(Publication.objects.get(pk=publication.pk).current_state, self.public)
+            self.assertEqual(permissions.utils.has_permission(publication, self.owner, "edit"), False)
+
+            utils.set_state(publication, self.private)
+            self.assertEqual(Publication.objects.get(pk=publication.pk).current_state, self.private)
+            self.assertEqual(permissions.utils.has_permission(publication, self.owner, "edit"), True)
+
+            utils.do_transition_bulk(Publication.objects.all(), "Make public", self.owner)
+            self.assertEqual(Publication.objects.public().get(), publication)
+            self.assertEqual(self.get_state_relations().exists(), False)
+
+    def test_save_without_state(self):
+        def get_codenames(publication):
+            return set(ObjectPermission.objects.filter(
+                content_type=self.ctype, content_id=publication.pk
+            ).values_list("permission__codename", flat=True))
+
+        self.publication.current_state = None
+        self.publication.save()
+        self.assertEqual(self.get_state_relations().exists(), False)
+        self.assertEqual(get_codenames(self.publication), set())
+
+        with self.settings(WORKFLOWS_STATE_RELATIONS=False):
+            publication = Publication.objects.create(name="Standard", owner=self.owner)
+            self.assertEqual(get_codenames(publication), set(["view", "edit"]))
+            publication.set_state(None)
+            self.assertEqual(Publication.objects.get(pk=publication.pk).current_state, None)
+            self.assertEqual(get_codenames(publication), set())
+
+    def test_save_after_bulk_operations(self):
+        with self.settings(WORKFLOWS_STATE_RELATIONS=False):
+            publications = Publication.objects.bulk_create([Publication(name="Bulk", owner=self.owner)])
+            publications.append(self.publication)
+            for publication in publications:
+                publication.name = "Renamed"
+                with self.assertNumQueries(1):
+                    publication.save()
+
+            utils.do_transition_bulk(publications, "Make public", self.owner)
+            for publication in publications:
+                publication.name = "Public"
+                with self.assertNumQueries(1):
+                    publication.save()
+
+    def test_backfill_current_state(self):
+        publication = self.publication
+        utils.set_state(publication, self.public)
+        Publication.objects.filter(pk=publication.pk).update(current_state=None)
+
+        call_command("backfill_current_state", "tests.Publication", delete_relations=True, stdout=StringIO())
+        self.assertEqual(Publication.objects.get(pk=publication.pk).current_state, self.public)
+        self.assertEqual(self.get_state_relations().exists(), False)
+
+
+class HistoryTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.owner = self.publication.owner
+        for i in range(2):
+            self.publication.do_make_public(self.owner)
+            self.publication.do_make_private(self.owner)
+        self.ids = list(WorkflowHistorical.objects.order_by("id").values_list("id", flat=True))
+
+    def test_history(self):
+        self.assertEqual([h.id for h in self.publication.history(chunk_size=2)], self.ids[::-1])
+        self.assertEqual([h.id for h in self.publication.reverse_history(chunk_size=2)], self.ids)
+
+    def test_history_page(self):
+        entries, cursor = self.publication.history_page(limit=2)
+        self.assertEqual([h.id for h in entries], self.ids[:-3:-1])
+
+        with self.assertNumQueries(1):
+            entries, cursor = self.publication.history_page(limit=2, cursor=cursor)
+            self.assertEqual([(h.state.name, h.transition.name, h.user) for h in entries], [
+                ("Private", "Make private", self.owner), ("Public", "Make public", self.owner)
+            ])
+
+        entries, cursor = self.publication.history_page(limit=2, cursor=cursor)
+        self.assertEqual([h.id for h in entries], self.ids[:1])
+        self.assertEqual(cursor, None)
+
+    def test_since(self):
+        since = datetime.datetime(2030, 1, 1)
+        WorkflowHistorical.objects.filter(id__in=self.ids[3:]).update(update_at=since)
+        self.assertEqual([h.id for h in self.publication.reverse_history(since=since)], self.ids[3:])
+
+        entries, cursor = self.publication.history_page(recent_first=False, since=since)
+        self.assertEqual([h.id for h in entries], self.ids[3:])
+        self.assertEqual(cursor, None)
+
+
+class ReportingTestCase(TestCase):
+
+    def setUp(self):
+        publication = create_publication()
+        publication.do_make_public(publication.owner)
+        publication.do_make_private(publication.owner)
+        Publication.objects.create(name="Other", owner=publication.owner)
+
+        self.private = State.objects.get(name="Private")
+        self.public = State.objects.get(name="Public")
+        self.make_public = Transition.objects.get(name="Make public")
+        self.make_private = Transition.objects.get(name="Make private")
+
+        dates = [
+            datetime.datetime(2030, 1, 1, 10), datetime.datetime(2030, 1, 1, 12),
+            datetime.datetime(2030, 1, 2, 12), datetime.datetime(2030, 1, 2)
+        ]
+        for pk, date in zip(WorkflowHistorical.objects.order_by("id").values_list("id", flat=True), dates):
+            WorkflowHistorical.objects.filter(pk=pk).update(update_at=date)
+
+    def test_transition_counts(self):
+        with self.assertNumQueries(1):
+            counts = WorkflowHistorical.objects.get_transition_counts(content_type=Publication)
+        self.assertEqual([(c["bucket"], c["state"], c["transition"], c["count"]) for c in counts], [
+            (datetime.datetime(2030, 1, 1), self.private.id, None, 1),
+            (datetime.datetime(2030, 1, 1), self.public.id, self.make_public.id, 1),
+            (datetime.datetime(2030, 1, 2), self.private.id, None, 1),
+            (datetime.datetime(2030, 1, 2), self.private.id, self.make_private.id, 1),
+        ])
+
+        counts = WorkflowHistorical.objects.get_transition_counts("month", since=datetime.datetime(2030, 1, 2))
+        self.assertEqual([(c["bucket"], c["count"]) for c in counts], [
+            (datetime.datetime(2030, 1, 1), 1), (datetime.datetime(2030, 1, 1), 1)
+        ])
+
+    def test_dwell_times(self):
+        dwell_times = WorkflowHistorical.objects.get_dwell_times(Publication)
+        self.assertEqual(dwell_times, {
+            self.private.id: {"count": 1, "total": 7200.0, "average": 7200.0, "minimum": 7200.0, "maximum": 7200.0},
+            self.public.id: {"count": 1, "total": 86400.0, "average": 86400.0, "minimum": 86400.0, "maximum": 86400.0},
+        })
+
+        versions = WorkflowHistorical.objects.filter_history(Publication)
+        self.assertEqual(WorkflowHistorical.objects._get_dwell_times_in_python(versions), dwell_times)
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        for i in range(2):
+            self.publication.do_make_public(self.publication.owner)
+            self.publication.do_make_private(self.publication.owner)
+        self.ids = list(WorkflowHistorical.objects.order_by("id").values_list("id", flat=True))
+        for day, pk in enumerate(self.ids[:3], 1):
+            WorkflowHistorical.objects.filter(pk=pk).update(update_at=datetime.datetime(2000, 1, day))
+
+    def test_archive(self):
+        with self.settings(WORKFLOWS_HISTORY_ARCHIVE=True):
+            call_command("archive_history", days=30, batch_size=2, stdout=StringIO())
+            self.assertEqual(
+                list(WorkflowHistorical.objects.order_by("id").values_list("id", flat=True)), self.ids[3:]
+            )
+            self.assertEqual(
+                list(WorkflowHistoricalArchive.objects.order_by("id").values_list("id", flat=True)), self.ids[:3]
+            )
+
+            self.assertEqual([h.id for h in self.publication.history(chunk_size=2)], self.ids[::-1])
+            self.assertEqual([h.id for h in self.publication.reverse_history(chunk_size=2)], self.ids)
+            self.assertEqual(
+                [h.id for h in self.publication.history(since=datetime.datetime(2000, 1, 2))], self.ids[:0:-1]
+            )
+
+            # the recent history is read from the live table only
+            with self.assertNumQueries(1):
+                entries, cursor = self.publication.history_page(limit=1)
+            self.assertEqual([h.id for h in entries], self.ids[-1:])
+
+    def test_archive_disabled(self):
+        self.assertRaises(CommandError, call_command, "archive_history", days=30, stdout=StringIO())
+
+
+class HistoryBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.publication = create_publication()
+        self.owner = self.publication.owner
+
+    def test_buffered_history(self):
+        with buffered_history():
+            self.publication.do_make_public(self.owner)
+            self.publication.do_make_private(self.owner)
+            Publication.objects.create(name="Other", owner=self.owner)
+            with buffered_history():
+                self.publication.do_make_public(self.owner)
+            # the nested buffer is written by the outermost one
+            self.assertEqual(WorkflowHistorical.objects.count(), 1)
+        self.assertEqual(WorkflowHistorical.objects.count(), 5)
+
+        with self.assertNumQueries(1):
+            with buffered_history():
+                pass
+            with buffered_history():
+                WorkflowHistorical.objects.count()
+
+    def test_discard(self):
+        try:
+            with buffered_history():
+                self.publication.do_make_public(self.owner)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(WorkflowHistorical.objects.count(), 1)
+
+    def test_nested_atomic_block(self):
+        with buffered_history():
+            self.publication.do_make_public(self.owner)
+            try:
+                with atomic():
+                    # written right away, and rolled back with the savepoint
+                    self.publication.do_make_private(self.owner)
+                    self.assertEqual(WorkflowHistorical.objects.count(), 2)
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(WorkflowHistorical.objects.count(), 1)
+        self.assertEqual(WorkflowHistorical.objects.count(), 2)
+
+    def test_decorator(self):
+        @buffered_history
+        def make_public(publication):
+            publication.do_make_public(self.owner)
+            self.assertEqual(WorkflowHistorical.objects.count(), 1)
+
+        make_public(self.publication)
+        self.assertEqual(WorkflowHistorical.objects.count(), 2)
+
+
+class WorkflowConstructionTestCase(TestCase):
+
+    def get_definition(self, size):
+        definition = copy.deepcopy(settings.WORKFLOWS["workflows.tests.models.Publication"])
+        for i in range(size):
+            definition["states"].append({
+                "name": "State %s" % i,
+                "state_perm_relation": [{"role": "Owner", "permission": "view"}],
+            })
+            definition["transitions"].append({
+                "name": "Go to %s" % i,
+                "destination": "State %s" % i,
+                "permission": "edit",
+                "description": "",
+            })
+            definition["state_transitions"]["State %s" % i] = ["Make private", "Make public"]
+        return definition
+
+    def create_workflow(self, definition):
+        with self.settings(WORKFLOWS={"workflows.tests.models.Publication": definition}):
+            with CaptureQueriesContext(connection) as queries:
+                workflow = utils.get_or_create_workflow(Publication)
+        return workflow, len(queries)
+
+    def test_statements(self):
+        workflow, count = self.create_workflow(self.get_definition(0))
+        graph = get_graph(workflow)
+        self.assertEqual(graph.get_initial_state().name, "Private")
+        self.assertEqual([t.name for t in graph.get_transitions(graph.get_state("Private"))], ["Make public"])
+        self.assertEqual(graph.get_roles(graph.get_state("Private"), "edit"), frozenset([Role.objects.get(name="Owner").id]))
+        self.assertEqual(graph.workflow_permission_ids, frozenset(Permission.objects.values_list("id", flat=True)))
+
+        workflow.delete()
+        WorkflowModelRelation.objects.all().delete()
+        workflow, large_count = self.create_workflow(self.get_definition(30))
+        self.assertEqual(workflow.states.count(), 32)
+        self.assertEqual(Transition.objects.filter(workflow=workflow).count(), 32)
+        self.assertEqual(State.transitions.through.objects.filter(state__workflow=workflow).count(), 62)
+        # the roles and permissions exist already
+        self.assertEqual(large_count, count - 4)
+
+
+class SyncTestCase(TestCase):
+
+    def setUp(self):
+        self.definition = copy.deepcopy(settings.WORKFLOWS["workflows.tests.models.Publication"])
+
+    def sync(self, dry_run=False):
+        out = StringIO()
+        with self.settings(WORKFLOWS={"workflows.tests.models.Publication": self.definition}):
+            call_command("sync_workflows", dry_run=dry_run, stdout=out)
+        return out.getvalue()
+
+    def test_create(self):
+        self.assertIn("create workflow PUBLICATION_WORKFLOW", self.sync(dry_run=True))
+        self.assertEqual(Workflow.objects.exists(), False)
+
+        self.sync()
+        workflow = utils.get_workflow_for_model(ContentType.objects.get_for_model(Publication))
+        self.assertEqual(workflow.name, "PUBLICATION_WORKFLOW")
+        self.assertEqual(self.sync(), "workflows.tests.models.Publication: up to date\n")
+
+    def test_diff(self):
+        publication = create_publication()
+        workflow = publication.get_workflow()
+
+        self.definition["states"][0]["alias"] = "Published"
+        self.definition["states"].append({
+            "name": "Pending", "state_perm_relation": [{"role": "Anonymous", "permission": "view"}]
+        })
+        self.definition["transitions"].append({
+            "name": "Make pending", "destination": "Pending", "permission": "edit", "description": ""
+        })
+        self.definition["state_transitions"] = {"Private": ["Make public", "Make pending"], "Pending": ["Make public"]}
+        self.definition["initial_state"]["state_perm_relation"].pop()
+
+        plan = self.sync(dry_run=True)
+        self.assertEqual(plan.splitlines()[2:], [
+            "  - create state Pending",
+            "  - update state Public",
+            "  - create transition Make pending",
+            "  - grant view to Anonymous in state Pending",
+            "  - revoke edit from Owner in state Private",
+            "  - update the permissions of the objects in state Private",
+            "  - add transition Make public to state Pending",
+            "  - add transition Make pending to state Private",
+            "  - remove transition Make private from state Public",
+        ])
+        self.assertEqual(get_graph(workflow).get_state("Pending"), None)
+
+        self.assertEqual(self.sync().splitlines()[1:], plan.splitlines()[2:])
+        graph = get_graph(workflow)
+        pending = graph.get_state("Pending")
+        self.assertEqual(graph.get_state("Public").alias, "Published")
+        self.assertEqual(set(t.name for t in graph.get_transitions(graph.get_state("Private"))), set([
+            "Make pending", "Make public"
+        ]))
+        self.assertEqual(graph.get_transitions(graph.get_state("Public")), [])
+        self.assertEqual(graph.get_transition("Make pending").destination, pending)
+        self.assertEqual(graph.get_roles(pending, "view"), frozenset([Role.objects.get(name="Anonymous").id]))
+        self.assertEqual(graph.get_roles(graph.get_state("Private"), "edit"), frozenset())
+        self.assertEqual(permissions.utils.has_permission(publication, publication.owner, "edit"), False)
+        self.assertEqual(permissions.utils.has_permission(publication, publication.owner, "view"), True)
+
+        self.assertEqual(self.sync(), "workflows.tests.models.Publication: up to date\n")
+
 
 # Helpers ####################################################################
 
@@ -7,14 +7,17 @@ from django.db.transaction import atomic
 from permissions.models import ObjectPermission, Permission, Role
 from permissions import utils as perm_utils
 
+from history import write_history
+from settings import BULK_BATCH_SIZE
+
 
 @atomic
 def get_or_create_workflow(model):
     """
     Iterate for the application workflow list and configure each workflow listed in WORKFLOWS settings
-    """
-    from models import State, Workflow, StatePermissionRelation, WorkflowPermissionRelation, Transition
 
+    The workflows can also be created or updated beforehand with the sync_workflows management command
+    """
     try:
         workflow = get_workflow_for_model(ContentType.objects.get_for_model(model))
     except Exception as e:
@@ -27,117 +30,220 @@ def get_or_create_workflow(model):
         if not wf_item:
             return None
 
-        try:
-            wf_name = wf_item['name']
+        workflow = create_workflow(model, parse_workflow_definition(wf_item))
 
-            # ROLES
-            dict_roles = {}
-            roles = get_wf_dict_value(wf_item, 'roles', wf_name)
-            for role in roles:
-                dict_roles[role], created = Role.objects.get_or_create(name=role)
+    return workflow
 
-            # PERMISSIONS
-            dict_permissions = {}
-            permissions = get_wf_dict_value(wf_item, 'permissions', wf_name)
 
-            for permission in permissions:
-                perm_name = get_wf_dict_value(permission, 'name', 'permissions', wf_name)
-                perm_codename = get_wf_dict_value(permission, 'codename', 'permissions', wf_name)
+def create_workflow(model, definition):
+    """Creates the workflow of the passed definition (see
+    parse_workflow_definition) and sets it to the passed model.
 
-                dict_permissions[perm_codename] = perm_utils.register_permission(
-                    name=perm_name,
-                    codename=perm_codename
-                )
-                # the permission registration returned False if the permission already exists
-                if not dict_permissions[perm_codename]:
-                    dict_permissions[perm_codename] = Permission.objects.get(name=perm_name, codename=perm_codename)
-
-            # creating workflow
-            workflow = Workflow.objects.create(name=wf_name)
-            # setting model
-            workflow.set_to_model(ContentType.objects.get_for_model(model))
-
-            dict_states = {}
-            # INITIAL STATE
-            initial_state = get_wf_dict_value(wf_item, 'initial_state', wf_name)
-            initial_state_name = get_wf_dict_value(initial_state, 'name', wf_name, 'initial_state')
-            initial_state_alias = initial_state.get('alias', None)
-
-            wf_initial_state = State.objects.create(name=initial_state_name, alias=initial_state_alias, workflow=workflow)
-            dict_states[initial_state_name] = wf_initial_state
-            # sets and save the initial state
-            workflow.initial_state = wf_initial_state
-            workflow.save()
-
-            state_perm_relations = initial_state.get('state_perm_relation', False)
-            # if [True] creates the State Permission Relation
-            if state_perm_relations:
-                for state_perm_relation in state_perm_relations:
-                    role = get_wf_dict_value(state_perm_relation, 'role', wf_name, 'state_perm_relation')
-                    permission = get_wf_dict_value(state_perm_relation, 'permission', wf_name, 'state_perm_relation')
-                    StatePermissionRelation.objects.get_or_create(
-                        state=wf_initial_state,
-                        role=get_wf_dict_value(dict_roles, role, wf_name, 'dict_roles'),
-                        permission=get_wf_dict_value(dict_permissions, permission, wf_name, 'dict_permissions')
-                    )
-
-            # STATES
-            states = get_wf_dict_value(wf_item, 'states', wf_name)
-            for state in states:
-                state_name = get_wf_dict_value(state, 'name', wf_name, 'states')
-                state_alias = state.get('alias', None)
-
-                wf_state = State.objects.create(name=state_name, alias=state_alias, workflow=workflow)
-                dict_states[state_name] = wf_state
-
-                state_perm_relations = state.get('state_perm_relation', False)
-                # if [True] creates the State Permission Relation
-                if state_perm_relations:
-                    for state_perm_relation in state_perm_relations:
-                        role = get_wf_dict_value(state_perm_relation, 'role', wf_name, 'state_perm_relation')
-                        permission = get_wf_dict_value(state_perm_relation, 'permission', wf_name, 'state_perm_relation')
-                        StatePermissionRelation.objects.get_or_create(
-                            state=wf_state,
-                            role=get_wf_dict_value(dict_roles, role, wf_name, 'dict_roles'),
-                            permission=get_wf_dict_value(dict_permissions, permission, wf_name, 'dict_permissions')
-                        )
-
-            # creating the Workflow Permission Relation
-            for wf_permission in dict_permissions.itervalues():
-                WorkflowPermissionRelation.objects.get_or_create(workflow=workflow, permission=wf_permission)
-
-            # TRANSITIONS
-            dict_transitions = {}
-            transitions = get_wf_dict_value(wf_item, 'transitions', wf_name)
-            for transition in transitions:
-                name = get_wf_dict_value(transition, 'name', wf_name, 'transitions')
-                destination = get_wf_dict_value(transition, 'destination', wf_name, 'transitions')
-                permission = get_wf_dict_value(transition, 'permission', wf_name, 'transitions')
-
-                wf_transition, created = Transition.objects.get_or_create(
-                    name=name,
-                    workflow=workflow,
-                    destination=get_wf_dict_value(dict_states, destination, wf_name, 'dict_states'),
-                    permission=get_wf_dict_value(dict_permissions, permission, wf_name, 'dict_permissions'),
-                    description=get_wf_dict_value(transition, 'description', wf_name, 'transitions'),
-                    condition=transition.get('condition', ''),
-                )
+    The existing roles and permissions are looked up with one IN query each,
+    and the missing rows of each table are created with one bulk insert, so
+    the number of statements doesn't depend on the size of the definition.
+    """
+    from graph import invalidate_graph
+    from models import State, Workflow, StatePermissionRelation, WorkflowPermissionRelation, Transition
 
-                dict_transitions[name] = wf_transition
+    dict_roles = get_or_create_roles(definition['roles'])
+    dict_permissions = get_or_create_permissions(definition['permissions'])
+
+    # creating workflow
+    workflow = Workflow.objects.create(name=definition['name'])
+    # setting model
+    workflow.set_to_model(ContentType.objects.get_for_model(model))
+
+    State.objects.bulk_create([
+        State(name=state_name, alias=state_alias, workflow=workflow)
+        for state_name, state_alias in definition['states'].items()
+    ])
+    dict_states = dict((state.name, state) for state in State.objects.filter(workflow=workflow))
+
+    # sets and save the initial state
+    workflow.initial_state = dict_states[definition['initial_state']]
+    workflow.save()
+
+    StatePermissionRelation.objects.bulk_create([
+        StatePermissionRelation(
+            state=dict_states[state_name], role=dict_roles[role], permission=dict_permissions[permission]
+        )
+        for state_name, role, permission in definition['state_permissions']
+    ])
+
+    # creating the Workflow Permission Relation
+    WorkflowPermissionRelation.objects.bulk_create([
+        WorkflowPermissionRelation(workflow=workflow, permission=wf_permission)
+        for wf_permission in dict_permissions.itervalues()
+    ])
+
+    Transition.objects.bulk_create([
+        Transition(
+            name=name,
+            workflow=workflow,
+            destination=dict_states[destination],
+            permission=dict_permissions[permission],
+            description=description,
+            condition=condition
+        )
+        for name, (destination, permission, description, condition) in definition['transitions'].items()
+    ])
+    dict_transitions = dict(
+        (transition.name, transition) for transition in Transition.objects.filter(workflow=workflow)
+    )
+
+    # CREATING THE STATE TRANSITIONS RELATION
+    through = State.transitions.through
+    through.objects.bulk_create([
+        through(state=dict_states[state_name], transition=dict_transitions[transition_name])
+        for state_name, transition_name in definition['state_transitions']
+    ])
+
+    # the bulk inserts don't send the signals which keep the compiled graph in sync
+    invalidate_graph(workflow.id)
+    return workflow
 
-            # CREATING THE STATE TRANSITIONS RELATION
-            state_transitions = get_wf_dict_value(wf_item, 'state_transitions', wf_name)
-            for state_name, transitions in state_transitions.items():
-                state = get_wf_dict_value(dict_states, state_name, wf_name, 'dict_states')
 
-                for transition_name in transitions:
-                    transition = get_wf_dict_value(dict_transitions, transition_name, wf_name, 'dict_transitions')
-                    state.transitions.add(transition)
+def parse_workflow_definition(wf_item):
+    """Validates the passed workflow definition (an item of the WORKFLOWS
+    setting) and returns it as a dict with the keys:
 
-        except KeyError:
-            raise ImproperlyConfigured('The attribute or key (name), must be specified in the workflow configuration.')
+    name
+        The name of the workflow.
 
-    return workflow
+    roles
+        A list of role names.
+
+    permissions
+        A dict permission codename -> permission name.
+
+    initial_state
+        The name of the initial state.
+
+    states
+        A dict state name -> alias, the initial state included.
+
+    state_permissions
+        A set of (state name, role name, permission codename).
+
+    transitions
+        A dict transition name -> (destination state name, permission
+        codename, description, condition).
+
+    state_transitions
+        A set of (state name, transition name).
+
+    Raises ImproperlyConfigured if a key is missing or refers to an undefined
+    item.
+    """
+    try:
+        wf_name = wf_item['name']
+
+        # ROLES
+        roles = list(get_wf_dict_value(wf_item, 'roles', wf_name))
+        dict_roles = dict((role, role) for role in roles)
+
+        # PERMISSIONS
+        permissions = {}
+        for permission in get_wf_dict_value(wf_item, 'permissions', wf_name):
+            perm_name = get_wf_dict_value(permission, 'name', 'permissions', wf_name)
+            perm_codename = get_wf_dict_value(permission, 'codename', 'permissions', wf_name)
+            permissions[perm_codename] = perm_name
+
+        # STATES (the initial state first)
+        initial_state = get_wf_dict_value(wf_item, 'initial_state', wf_name)
+        initial_state_name = get_wf_dict_value(initial_state, 'name', wf_name, 'initial_state')
+
+        states = {}
+        state_permissions = set()
+        for state in [initial_state] + list(get_wf_dict_value(wf_item, 'states', wf_name)):
+            state_name = get_wf_dict_value(state, 'name', wf_name, 'states')
+            states[state_name] = state.get('alias', None)
+
+            # if [True] creates the State Permission Relation
+            for state_perm_relation in state.get('state_perm_relation', None) or []:
+                role = get_wf_dict_value(state_perm_relation, 'role', wf_name, 'state_perm_relation')
+                permission = get_wf_dict_value(state_perm_relation, 'permission', wf_name, 'state_perm_relation')
+                get_wf_dict_value(dict_roles, role, wf_name, 'dict_roles')
+                get_wf_dict_value(permissions, permission, wf_name, 'dict_permissions')
+                state_permissions.add((state_name, role, permission))
+
+        # TRANSITIONS
+        transitions = {}
+        for transition in get_wf_dict_value(wf_item, 'transitions', wf_name):
+            name = get_wf_dict_value(transition, 'name', wf_name, 'transitions')
+            destination = get_wf_dict_value(transition, 'destination', wf_name, 'transitions')
+            permission = get_wf_dict_value(transition, 'permission', wf_name, 'transitions')
+            get_wf_dict_value(states, destination, wf_name, 'dict_states')
+            get_wf_dict_value(permissions, permission, wf_name, 'dict_permissions')
+            transitions[name] = (
+                destination,
+                permission,
+                get_wf_dict_value(transition, 'description', wf_name, 'transitions'),
+                transition.get('condition', ''),
+            )
+
+        # STATE TRANSITIONS
+        state_transitions = set()
+        for state_name, transition_names in get_wf_dict_value(wf_item, 'state_transitions', wf_name).items():
+            get_wf_dict_value(states, state_name, wf_name, 'dict_states')
+            for transition_name in transition_names:
+                get_wf_dict_value(transitions, transition_name, wf_name, 'dict_transitions')
+                state_transitions.add((state_name, transition_name))
+
+    except KeyError:
+        raise ImproperlyConfigured('The attribute or key (name), must be specified in the workflow configuration.')
+
+    return {
+        'name': wf_name,
+        'roles': roles,
+        'permissions': permissions,
+        'initial_state': initial_state_name,
+        'states': states,
+        'state_permissions': state_permissions,
+        'transitions': transitions,
+        'state_transitions': state_transitions,
+    }
+
+
+def get_or_create_roles(names):
+    """Returns a dict name -> Role of the passed role names, creating the
+    missing roles with one bulk insert.
+    """
+    dict_roles = dict((role.name, role) for role in Role.objects.filter(name__in=names))
+    missing = [name for name in set(names) if name not in dict_roles]
+    if missing:
+        Role.objects.bulk_create([Role(name=name) for name in missing])
+        dict_roles.update((role.name, role) for role in Role.objects.filter(name__in=missing))
+    return dict_roles
+
+
+def get_or_create_permissions(permissions):
+    """Returns a dict codename -> Permission of the passed permissions (a dict
+    codename -> name), creating the missing permissions with one bulk insert.
+    Raises Permission.DoesNotExist if a permission exists with the same name or
+    codename but not both.
+    """
+    from django.db.models import Q
+
+    existing = Permission.objects.filter(Q(name__in=permissions.values()) | Q(codename__in=permissions.keys()))
+    dict_permissions = {}
+    for permission in existing:
+        if permissions.get(permission.codename) != permission.name:
+            raise Permission.DoesNotExist(
+                'Permission matching query does not exist: %s (%s)' % (permission.codename, permission.name)
+            )
+        dict_permissions[permission.codename] = permission
+
+    missing = [codename for codename in permissions if codename not in dict_permissions]
+    if missing:
+        Permission.objects.bulk_create([
+            Permission(name=permissions[codename], codename=codename) for codename in missing
+        ])
+        dict_permissions.update(
+            (permission.codename, permission) for permission in Permission.objects.filter(codename__in=missing)
+        )
+    return dict_permissions
 
 
 def get_wf_dict_value(dictionary, key, wf_name, parent_name=None):
@@ -164,7 +270,8 @@ def get_wf_dict_value(dictionary, key, wf_name, parent_name=None):
 
 
 def get_objects_for_workflow(workflow):
-    """Returns all objects which have passed workflow.
+    """Returns a lazy iterator over all objects which have passed workflow.
+    See Workflow.get_objects.
 
     **Parameters:**
 
@@ -183,6 +290,59 @@ def get_objects_for_workflow(workflow):
     return workflow.get_objects()
 
 
+def iterate_in_chunks(queryset, chunk_size=None):
+    """Iterates over the passed queryset fetching ``chunk_size`` rows per
+    query, ordered by primary key (keyset pagination), so that only one chunk
+    is held in memory at a time.
+
+    **Parameters:**
+
+    queryset
+        The queryset to iterate. Its ordering is replaced by the primary key.
+
+    chunk_size
+        The number of rows fetched per query. Defaults to the
+        WORKFLOWS_BULK_BATCH_SIZE setting.
+    """
+    chunk_size = chunk_size or BULK_BATCH_SIZE
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+
+def chunks(items, chunk_size=None):
+    """Yields successive slices of at most ``chunk_size`` items (the
+    WORKFLOWS_BULK_BATCH_SIZE setting by default) of the passed list.
+    """
+    chunk_size = chunk_size or BULK_BATCH_SIZE
+    for i in xrange(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def iterate_pks_in_chunks(queryset, chunk_size=None):
+    """Like iterate_in_chunks, but yields lists of at most ``chunk_size``
+    primary keys instead of model instances.
+    """
+    chunk_size = chunk_size or BULK_BATCH_SIZE
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1]
+
+
 def remove_workflow(ctype_or_obj):
     """Removes the workflow from the passed content type or object. After this
     function has been called the content type or object has no workflow
@@ -206,38 +366,54 @@ def remove_workflow(ctype_or_obj):
         remove_workflow_from_object(ctype_or_obj)
 
 
-def remove_workflow_from_model(ctype):
+def remove_workflow_from_model(ctype, batch_size=None, callback=None):
     """Removes the workflow from passed content type. After this function has
     been called the content type has no workflow anymore (the instances might
     have own ones).
 
+    The states, inheritance blocks and permissions of the instances which
+    don't have an own workflow are removed with set based deletes, one batch
+    of objects at a time (each batch in its own transaction, so that locks are
+    held briefly).
+
     ctype
         The content type from which the passed workflow should be removed.
         Must be a ContentType instance.
+
+    batch_size
+        The number of objects handled per batch. Defaults to the
+        WORKFLOWS_BULK_BATCH_SIZE setting.
+
+    callback
+        An optional callable which is called after each batch with the number
+        of processed objects and the total number of objects.
     """
     # First delete all states, inheritance blocks and permissions from ctype's
     # instances which have passed workflow.
-    from models import StateObjectRelation, WorkflowModelRelation
+    from permissions.models import ObjectPermissionInheritanceBlock
+    from models import StateObjectRelation, WorkflowModelRelation, WorkflowObjectRelation
 
-    workflow = get_workflow_for_model(ctype)
-    for obj in get_objects_for_workflow(workflow):
-        try:
-            ctype = ContentType.objects.get_for_model(obj)
-            sor = StateObjectRelation.objects.get(content_id=obj.id, content_type=ctype)
-        except StateObjectRelation.DoesNotExist:
-            pass
-        else:
-            sor.delete()
+    model = ctype.model_class()
+    if model is not None:
+        overwritten = WorkflowObjectRelation.objects.filter(
+            content_type=ctype, content_id__isnull=False).values('content_id')
+        queryset = model._default_manager.exclude(pk__in=overwritten)
+        total = queryset.count() if callback else None
 
-        # Reset all permissions
-        perm_utils.reset(obj)
+        processed = 0
+        for ids in iterate_pks_in_chunks(queryset, batch_size):
+            with atomic():
+                StateObjectRelation.objects.filter(content_type=ctype, content_id__in=ids).delete()
 
-    try:
-        wmr = WorkflowModelRelation.objects.get(content_type=ctype)
-    except WorkflowModelRelation.DoesNotExist:
-        pass
-    else:
-        wmr.delete()
+                # Reset all permissions
+                ObjectPermissionInheritanceBlock.objects.filter(content_type=ctype, content_id__in=ids).delete()
+                ObjectPermission.objects.filter(content_type=ctype, content_id__in=ids).delete()
+
+            processed += len(ids)
+            if callback:
+                callback(processed, total)
+
+    WorkflowModelRelation.objects.filter(content_type=ctype).delete()
 
 
 def remove_workflow_from_object(obj):
@@ -347,11 +523,9 @@ def get_workflow(obj):
         The object for which the workflow should be returend. Can be any
         Django model instance.
     """
-    workflow = get_workflow_for_object(obj)
-    if workflow is not None:
-        return workflow
+    from graph import resolve_workflow
 
-    return get_or_create_workflow(obj.__class__)
+    return resolve_workflow(obj)
 
 
 def get_workflow_for_object(obj):
@@ -402,7 +576,10 @@ def get_state(obj):
         The object for which the workflow state should be returned. Can be any
         Django model instance.
     """
-    from models import StateObjectRelation, WorkflowModelRelation
+    from models import StateObjectRelation
+
+    if not uses_state_relations(obj.__class__):
+        return obj.current_state
 
     ctype = ContentType.objects.get_for_model(obj)
     try:
@@ -424,19 +601,88 @@ def set_state(obj, state):
         Django model instance.
 
     state
-        The state which should be set to the passed object.
+        The state which should be set to the passed object. If None, the state
+        relation and the workflow permissions of the object are deleted.
     """
     from models import StateObjectRelation
 
-    ctype = ContentType.objects.get_for_model(obj)
-    try:
-        sor = StateObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
-    except StateObjectRelation.DoesNotExist:
-        sor = StateObjectRelation.objects.create(content=obj, state=state)
+    state_id = state.id if state is not None else None
+    if not uses_state_relations(obj.__class__):
+        if obj.current_state_id != state_id:
+            # saving the new current state calls back with the state assigned
+            return obj.set_state(state)
+    elif state is None:
+        StateObjectRelation.objects.filter(
+            content_type=ContentType.objects.get_for_model(obj), content_id=obj.id
+        ).delete()
+    else:
+        ctype = ContentType.objects.get_for_model(obj)
+        try:
+            sor = StateObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
+        except StateObjectRelation.DoesNotExist:
+            sor = StateObjectRelation.objects.create(content=obj, state=state)
+        else:
+            sor.state = state
+            sor.save()
+    # the prefetched transitions belong to the previous state
+    obj.__dict__.pop('_prefetched_allowed_transitions', None)
+    if state is not None:
+        update_permissions(obj, state)
     else:
-        sor.state = state
-        sor.save()
-    update_permissions(obj)
+        workflow = get_workflow(obj)
+        if workflow is not None:
+            update_permissions_bulk(obj.__class__, [obj.id], workflow, None)
+
+
+def uses_state_relations(model):
+    """Returns True if the state of the objects of the passed model is stored
+    with StateObjectRelation rows.
+
+    With the WORKFLOWS_STATE_RELATIONS setting set to False, the models with
+    a current_state column (see WorkflowBase) only store their state there,
+    which saves a write and a read per state change. Other models always use
+    the state relations.
+    """
+    from models import WorkflowBase
+
+    return getattr(settings, 'WORKFLOWS_STATE_RELATIONS', True) or not issubclass(model, WorkflowBase)
+
+
+def backfill_current_state(model, batch_size=None, delete_relations=False):
+    """Copies the state of the StateObjectRelation rows of the objects of the
+    passed model into their current_state column, with one update per state
+    and batch. Returns the number of updated objects.
+
+    **Parameters:**
+
+    model
+        A model with a current_state column (see WorkflowBase).
+
+    batch_size
+        The number of state relations handled per batch. Defaults to the
+        WORKFLOWS_BULK_BATCH_SIZE setting.
+
+    delete_relations
+        If True, the state relations are deleted once copied.
+    """
+    from models import StateObjectRelation
+
+    ctype = ContentType.objects.get_for_model(model)
+    relations = StateObjectRelation.objects.filter(content_type=ctype)
+
+    updated = 0
+    for pks in iterate_pks_in_chunks(relations, batch_size):
+        with atomic():
+            by_state = {}
+            for content_id, state_id in relations.filter(pk__in=pks).values_list('content_id', 'state'):
+                by_state.setdefault(state_id, []).append(content_id)
+            for state_id, ids in by_state.items():
+                updated += model._base_manager.filter(pk__in=ids).exclude(current_state=state_id).update(
+                    current_state=state_id
+                )
+            if delete_relations:
+                StateObjectRelation.objects.filter(pk__in=pks).delete()
+    return updated
 
 
 def set_initial_state(obj):
@@ -451,6 +697,9 @@ def get_allowed_transitions(obj, user):
     """Returns all allowed transitions for passed object and user. Takes the
     current state of the object into account.
 
+    If the transitions have been prefetched for the user with
+    get_allowed_transitions_bulk, the prefetched result is returned.
+
     **Parameters:**
 
     obj
@@ -459,13 +708,114 @@ def get_allowed_transitions(obj, user):
     user
         The user for which the transitions are allowed.
     """
-    state = obj.current_state or get_state(obj)
+    prefetched = getattr(obj, '_prefetched_allowed_transitions', {})
+    if user.pk in prefetched:
+        return prefetched[user.pk]
+
+    state = get_current_state(obj)
     if state is None:
         return []
 
     return state.get_allowed_transitions(obj, user)
 
 
+def get_allowed_transitions_bulk(objs, user):
+    """Returns the allowed transitions for each of the passed objects and the
+    passed user, as a dict object pk -> list of transitions.
+
+    The roles of the user (global and local to the objects) come from the
+    role cache, which fetches the missing ones with one query, and the granted
+    object permissions are fetched with one query, whatever the number of
+    objects. The result is also stored on each object, so that further calls
+    to get_allowed_transitions for the same user don't hit the database.
+
+    **Parameters:**
+
+    objs
+        The objects for which the transitions should be returned. Any
+        iterable of Django model instances of the same model.
+
+    user
+        The user for which the transitions are allowed.
+    """
+    from django.db.models import Q
+    from graph import get_graph_for_state
+    from roles import get_global_role_ids, get_local_role_ids_bulk
+
+    objs = list(objs)
+    candidates = {}
+    permission_ids = set()
+    for obj in objs:
+        state = get_current_state(obj)
+        transitions = get_graph_for_state(state).get_transitions(state) if state is not None else []
+        candidates[obj.pk] = transitions
+        permission_ids.update(t.permission_id for t in transitions if t.permission_id is not None)
+
+    granted = {}
+    if permission_ids:
+        global_roles = get_global_role_ids(user)
+        local_roles = get_local_role_ids_bulk(user, objs)
+
+        role_ids = global_roles.union(*local_roles.values())
+        if role_ids:
+            content_filter = Q()
+            for ctype, ids in _group_by_content_type(objs).items():
+                content_filter |= Q(content_type=ctype, content_id__in=ids)
+
+            object_permissions = ObjectPermission.objects.filter(
+                content_filter,
+                permission__in=permission_ids,
+                role__in=role_ids
+            ).values_list('content_id', 'role', 'permission')
+            for content_id, role_id, permission_id in object_permissions:
+                if role_id in global_roles or role_id in local_roles.get(content_id, ()):
+                    granted.setdefault(content_id, set()).add(permission_id)
+
+    result = {}
+    for obj in objs:
+        obj_granted = granted.get(obj.pk, ())
+        result[obj.pk] = [
+            t for t in candidates[obj.pk] if t.permission_id is None or t.permission_id in obj_granted
+        ]
+        prefetched = obj.__dict__.setdefault('_prefetched_allowed_transitions', {})
+        prefetched[user.pk] = result[obj.pk]
+
+    return result
+
+
+def _group_by_content_type(objs):
+    """Returns a dict content type -> list of ids of the passed objects.
+    """
+    groups = {}
+    for obj in objs:
+        groups.setdefault(ContentType.objects.get_for_model(obj), []).append(obj.pk)
+    return groups
+
+
+def get_current_state(obj):
+    """Returns the current workflow state for the passed object, taking it
+    from the compiled workflow graph when the object has a current_state
+    column, so that no query is needed.
+
+    **Parameters:**
+
+    obj
+        The object for which the workflow state should be returned. Can be any
+        Django model instance.
+    """
+    from graph import get_graph
+
+    state_id = getattr(obj, 'current_state_id', None)
+    if state_id is not None:
+        workflow = obj.get_workflow()
+        state = get_graph(workflow).states.get(state_id) if workflow else None
+        if state is not None:
+            return state
+        return obj.current_state
+
+    return get_state(obj)
+
+
 def do_transition(obj, transition, user):
     """Processes the passed transition to the passed object (if allowed).
     """
@@ -477,46 +827,288 @@ def do_transition(obj, transition, user):
         return False
 
 
-def update_permissions(obj):
-    """Updates the permissions of the passed object according to the object's
-    current workflow state.
+def do_transition_bulk(objs, transition, user, comment=None, batch_size=None):
+    """Processes the passed transition to each of the passed objects (if
+    allowed), with set based statements instead of one object at a time.
+
+    The permissions are checked per batch of objects (see
+    get_allowed_transitions_bulk). For the allowed objects of each batch the
+    current state is changed with one UPDATE, and the state relations, the
+    object permissions and the history are replaced with one delete and one
+    bulk insert each. Everything runs inside one transaction.
+
+    Returns a dict object pk -> True if the transition has been processed,
+    False otherwise.
+
+    **Parameters:**
+
+    objs
+        A queryset or a list of instances of one workflow enabled model.
+
+    transition
+        The transition to process. Can be a Transition instance or a string
+        with the transition name.
+
+    user
+        The user who processes the transition.
+
+    comment
+        The comment saved in the history of each object.
+
+    batch_size
+        The number of objects handled by each statement. Defaults to the
+        WORKFLOWS_BULK_BATCH_SIZE setting.
+    """
+    from django.db.models.query import QuerySet
+    from graph import get_graph
+    from models import Transition
+
+    batch_size = batch_size or BULK_BATCH_SIZE
+    if isinstance(objs, QuerySet):
+        model = objs.model
+        objs = objs.iterator()
+    else:
+        objs = list(objs)
+        if not objs:
+            return {}
+        model = objs[0].__class__
+
+    if not isinstance(transition, Transition):
+        workflow = get_or_create_workflow(model)
+        transition = get_graph(workflow).get_transition(transition) if workflow else None
+        if transition is None:
+            return dict((obj.pk, False) for obj in objs)
+
+    workflow = transition.workflow
+    state = get_graph(workflow).states.get(transition.destination_id) or transition.destination
+
+    results = {}
+    with atomic():
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) == batch_size:
+                results.update(_do_transition_batch(model, batch, transition, state, workflow, user, comment))
+                batch = []
+        if batch:
+            results.update(_do_transition_batch(model, batch, transition, state, workflow, user, comment))
+
+    return results
+
+
+def _do_transition_batch(model, objs, transition, state, workflow, user, comment):
+    """Processes the passed transition to one batch of objects. See
+    do_transition_bulk.
     """
-    from models import StatePermissionRelation
+    from models import StateObjectRelation, WorkflowBase, WorkflowHistorical
+
+    allowed = get_allowed_transitions_bulk(objs, user)
+    results = dict((obj.pk, transition in allowed[obj.pk]) for obj in objs)
+    ids = [pk for pk, success in results.items() if success]
+    if not ids:
+        return results
+
+    ctype = ContentType.objects.get_for_model(model)
+
+    # update current state
+    if issubclass(model, WorkflowBase):
+        model._base_manager.filter(pk__in=ids).update(current_state=state)
+
+    if uses_state_relations(model):
+        StateObjectRelation.objects.filter(content_type=ctype, content_id__in=ids).delete()
+        StateObjectRelation.objects.bulk_create([
+            StateObjectRelation(content_type=ctype, content_id=pk, state=state) for pk in ids
+        ])
+
+    update_permissions_bulk(model, ids, workflow, state)
+
+    # save history
+    write_history([
+        WorkflowHistorical(
+            content_type=ctype,
+            content_id=pk,
+            state=state,
+            transition=transition,
+            user=user,
+            comment=comment
+        ) for pk in ids
+    ])
+
+    for obj in objs:
+        obj.__dict__.pop('_prefetched_allowed_transitions', None)
+        if results[obj.pk] and isinstance(obj, WorkflowBase):
+            obj.current_state = state
+            # the new state is saved, so a later save doesn't apply it again
+            obj._loaded_values['current_state_id'] = state.id
+
+    return results
+
+
+def update_permissions(obj, state=None):
+    """Updates the permissions of the passed object according to the object's
+    current workflow state. See update_permissions_bulk.
+
+    **Parameters:**
+
+    obj
+        The object for which the permissions should be updated.
 
+    state
+        The new state of the object. Defaults to its current state.
+    """
     workflow = get_workflow(obj)
-    model_path = "%s.%s" % (obj.__class__.__module__, obj.__class__.__name__)
-    # finding workflow settings
-    workflows = getattr(settings, 'WORKFLOWS', {})
-    workflow_dict = workflows.get(model_path, None)
+    if workflow is not None:
+        state = state or get_current_state(obj)
+        update_permissions_bulk(obj.__class__, [obj.id], workflow, state)
+
+    # Remove all inheritance blocks from the object
+    # for wpr in WorkflowPermissionRelation.objects.filter(workflow=workflow):
+    #     permissions.utils.remove_inheritance_block(obj, wpr.permission)
+    #
+    # # Add inheritance blocks of this state to the object
+    # for sib in StateInheritanceBlock.objects.filter(state=state):
+    #     permissions.utils.add_inheritance_block(obj, sib.permission)
+
+
+def init_workflow_state_bulk(model, objs, workflow, state, user=None, comment=u""):
+    """Writes the state relation, the permissions and the history of the
+    initial state of the passed new objects, all of them of the passed model
+    and workflow, with one bulk insert each. New objects have none of these
+    rows yet (the rows of the deleted objects, whose ids may be reused, are
+    deleted with them, see delete_workflow_rows_bulk), so existing ones are
+    not looked for.
+    """
+    from models import StateObjectRelation, WorkflowHistorical
+
+    ct = ContentType.objects.get_for_model(model)
+    ids = [obj.pk for obj in objs]
+
+    if uses_state_relations(model):
+        StateObjectRelation.objects.bulk_create([
+            StateObjectRelation(content_type=ct, content_id=pk, state=state) for pk in ids
+        ])
+    grant_permissions_bulk(model, ids, workflow, state)
+    # save history
+    write_history([
+        WorkflowHistorical(
+            content_type=ct,
+            content_id=pk,
+            state=state,
+            user=user,
+            comment=comment
+        ) for pk in ids
+    ])
+
+
+def delete_workflow_rows_bulk(model, ids):
+    """Deletes the workflow rows of the passed deleted objects of the passed
+    model, which are not deleted with them as they are generic relations: the
+    state relations, the object permissions of the workflow roles and
+    permissions, and the local roles of the user_roles settings. Otherwise an
+    object reusing the id of a deleted one (SQLite and MySQL reuse the ids)
+    would get them. The history is kept.
+    """
+    from permissions.models import PrincipalRoleRelation
+    from graph import get_graph
+    from models import StateObjectRelation
 
-    if workflow_dict:
-        state = obj.current_state or get_state(obj)
-        ct = ContentType.objects.get_for_model(obj)
-        roles = workflow_dict['roles']
+    ct = ContentType.objects.get_for_model(model)
+    StateObjectRelation.objects.filter(content_type=ct, content_id__in=ids).delete()
+
+    workflow_dict = getattr(settings, 'WORKFLOWS', {}).get("%s.%s" % (model.__module__, model.__name__))
+    if not workflow_dict:
+        return
 
-        # Remove all permissions for the workflow
+    # not created if missing, the objects may be deleted with their workflow
+    workflow = get_workflow_for_model(ct)
+    if workflow is not None:
         ObjectPermission.objects.filter(
-            role__name__in=roles,
+            role__name__in=workflow_dict['roles'],
             content_type=ct,
-            content_id=obj.id,
-            permission__workflow_permissions__workflow=workflow
+            content_id__in=ids,
+            permission__in=get_graph(workflow).workflow_permission_ids
         ).delete()
 
-        # Grant permission for the state
-        object_permission_list = []
-        for spr in StatePermissionRelation.objects.filter(state=state):
-            object_permission_list.append(ObjectPermission(
-                role=spr.role,
+    user_roles = set(role for attributes, role, attname, principal_class in model.get_user_roles_spec())
+    if user_roles:
+        PrincipalRoleRelation.objects.filter(role__name__in=user_roles, content_type=ct, content_id__in=ids).delete()
+
+
+def update_permissions_bulk(model, ids, workflow, state):
+    """Updates the permissions of the passed objects (all of them of the
+    passed model and workflow) according to the passed state.
+
+    The permissions granted by the state (see StatePermissionRelation) are
+    compared with the object permissions the objects actually hold for the
+    workflow roles and permissions, fetched with one query per batch, so that
+    rows left by a relation which has been deleted since are removed too. Only
+    the difference is deleted and inserted, which is nothing at all if the
+    objects already have the permissions of the state.
+    """
+    from graph import get_graph
+
+    model_path = "%s.%s" % (model.__module__, model.__name__)
+    # finding workflow settings
+    workflows = getattr(settings, 'WORKFLOWS', {})
+    workflow_dict = workflows.get(model_path, None)
+
+    if workflow_dict:
+        ct = ContentType.objects.get_for_model(model)
+        workflow_graph = get_graph(workflow)
+        granted = workflow_graph.state_permissions.get(state.id, frozenset()) if state else frozenset()
+        roles = set(workflow_dict['roles'])
+        permission_ids = workflow_graph.workflow_permission_ids.union(p for r, p in granted)
+
+        for batch in chunks(list(ids)):
+            existing = dict((pk, set()) for pk in batch)
+            removed = []
+            rows = ObjectPermission.objects.filter(
                 content_type=ct,
-                content_id=obj.id,
-                permission=spr.permission
-            ))
-        ObjectPermission.objects.bulk_create(object_permission_list)
-
-        # Remove all inheritance blocks from the object
-        # for wpr in WorkflowPermissionRelation.objects.filter(workflow=workflow):
-        #     permissions.utils.remove_inheritance_block(obj, wpr.permission)
-        #
-        # # Add inheritance blocks of this state to the object
-        # for sib in StateInheritanceBlock.objects.filter(state=state):
-        #     permissions.utils.add_inheritance_block(obj, sib.permission)
\ No newline at end of file
+                content_id__in=batch,
+                permission__in=permission_ids
+            ).values_list('id', 'content_id', 'role', 'role__name', 'permission')
+            for pk, content_id, role_id, role_name, permission_id in rows:
+                pair = (role_id, permission_id)
+                managed = role_name in roles and permission_id in workflow_graph.workflow_permission_ids
+                if pair in granted and pair not in existing[content_id]:
+                    existing[content_id].add(pair)
+                elif pair in granted or managed:
+                    # a duplicate, or not granted by the state
+                    removed.append(pk)
+
+            if removed:
+                ObjectPermission.objects.filter(id__in=removed).delete()
+            missing = [
+                ObjectPermission(role_id=role_id, content_type=ct, content_id=content_id, permission_id=permission_id)
+                for content_id in batch for role_id, permission_id in granted
+                if (role_id, permission_id) not in existing[content_id]
+            ]
+            if missing:
+                ObjectPermission.objects.bulk_create(missing)
+
+
+def grant_permissions_bulk(model, ids, workflow, state):
+    """Grants the permissions of the passed state (see
+    StatePermissionRelation) to the passed objects, all of them of the passed
+    model and workflow, with one bulk insert. Existing object permissions are
+    not removed.
+    """
+    from graph import get_graph
+
+    model_path = "%s.%s" % (model.__module__, model.__name__)
+    if model_path not in getattr(settings, 'WORKFLOWS', {}):
+        return
+
+    ct = ContentType.objects.get_for_model(model)
+    _create_object_permissions(ct, ids, get_graph(workflow).state_permissions.get(state.id, ()))
+
+
+def _create_object_permissions(ct, ids, permissions):
+    """Inserts the passed (role id, permission id) pairs for each of the
+    passed object ids with one bulk insert.
+    """
+    if permissions:
+        ObjectPermission.objects.bulk_create([
+            ObjectPermission(role_id=role_id, content_type=ct, content_id=pk, permission_id=permission_id)
+            for pk in ids for role_id, permission_id in permissions
+        ])